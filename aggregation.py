@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+from header_parser import FISCAL_START, month_label
+from subject_index import KEY_NAME, normalize_subjects
+
+# 予算・実績の集計エンジン
+# 科目（正規化済み）× 月 の数値フレームにそろえてから、派生列をまとめて計算する
+BUDGET = "予算"
+ACTUAL = "実績"
+PREV_ACTUAL = "前年実績"
+DIFF = "差額"
+RATE = "対予算比"
+YOY = "前年比"
+MEASURES = [BUDGET, ACTUAL, PREV_ACTUAL, DIFF, RATE, YOY]
+# 整数（千円）で持つ計測値。率は小数1桁
+AMOUNT_MEASURES = [BUDGET, ACTUAL, PREV_ACTUAL, DIFF]
+
+# 期間集計の計測値
+BUDGET_TOTAL = "予算合計"
+ACTUAL_TOTAL = "実績合計"
+ACTUAL_MONTHS = "実績月数"
+FORECAST = "見込み"
+PREV_TOTAL = "前年実績合計"
+ROLLUP_MEASURES = [BUDGET_TOTAL, ACTUAL_TOTAL, DIFF, RATE, ACTUAL_MONTHS, FORECAST]
+ROLLUP_INT_MEASURES = [BUDGET_TOTAL, ACTUAL_TOTAL, PREV_TOTAL, DIFF, ACTUAL_MONTHS, FORECAST]
+
+QUARTER_COLUMNS = [(BUDGET_TOTAL, "予算合計"), (ACTUAL_TOTAL, "実績合計"), (DIFF, "差額"), (RATE, "達成率")]
+ANNUAL_COLUMNS = [(BUDGET_TOTAL, "年間予算"), (ACTUAL_TOTAL, "実績累計"), (DIFF, "差額"), (RATE, "進捗率"),
+                  (FORECAST, "年間見込み（単純月平均×12）")]
+
+# app.py のプレビュー列（{月}_予算 など）
+APP_COLUMNS = [(BUDGET, "予算"), (ACTUAL, "実績"), (RATE, "対予算比%"), (YOY, "前年比%"), (DIFF, "差額")]
+# 予実集計.py の月次予実表の列
+BATCH_COLUMNS = [(BUDGET, "予算"), (ACTUAL, "実績"), (DIFF, "差額"), (RATE, "達成率")]
+
+
+def keyed_amounts(df, columns, subject_col=None):
+    # 科目キーをインデックスにした数値フレーム。index_by_subject 済みの表はそのまま使う
+    out = df[list(columns)].apply(pd.to_numeric, errors="coerce")
+    if df.index.name == KEY_NAME:
+        return out
+    subjects = df[subject_col] if subject_col is not None else df.index
+    out.index = pd.Index(normalize_subjects(subjects).to_numpy(), name=KEY_NAME)
+    return out[~out.index.duplicated(keep="first")]
+
+
+def pick_columns(actual_data, cols):
+    # {月: (ファイルキー, カラム名)} から月ごとの数値列を取り出し、科目キーで横に結合する
+    by_file = {}
+    for month, (k, col) in cols.items():
+        if k in actual_data and col in actual_data[k].columns:
+            by_file.setdefault(k, []).append((month, col))
+    series = {}
+    for k, pairs in by_file.items():
+        keyed = keyed_amounts(actual_data[k], list(dict.fromkeys(col for _, col in pairs)))
+        for month, col in pairs:
+            series[month] = keyed[col]
+    return pd.DataFrame(series)
+
+
+def thousand_yen(frame):
+    return np.round(frame.astype(float) / 1000)
+
+
+def derive_monthly(b, a, p, subjects, months):
+    # 予算・実績・前年実績（科目 × 月 の2次元配列、千円単位）から差額・比率を計算し、
+    # index=科目名、columns=(月, 計測値) の数値フレームにする
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bz = np.where(b == 0, np.nan, b)
+        pz = np.where(p == 0, np.nan, p)
+        blocks = {
+            BUDGET: b,
+            ACTUAL: a,
+            PREV_ACTUAL: p,
+            DIFF: a - b,
+            RATE: np.round(a / bz * 100, 1),
+            YOY: np.round(a / pz * 100, 1),
+        }
+    # (月, 計測値) の順に並べ替えた2次元配列を一度に組み立てる
+    stacked = np.stack([blocks[m] for m in MEASURES], axis=2).reshape(len(subjects), len(months) * len(MEASURES))
+    columns = pd.MultiIndex.from_product([months, MEASURES], names=["月", "計測値"])
+    return pd.DataFrame(stacked, index=pd.Index(subjects, name="科目名"), columns=columns)
+
+
+def aggregate_monthly(budget_df, budget_subject_col, months, actual_data, actual_cols, prev_cols=None, subjects=None):
+    # actual_cols / prev_cols: {月: (ファイルキー, カラム名)}（ColumnResolver.current_map などの戻り値）
+    # 戻り値: index=科目名（subjects の順）、columns=(月, 計測値) の数値フレーム（千円単位）
+    if subjects is None:
+        subjects = list(budget_df[budget_subject_col])
+    keys = normalize_subjects(subjects).to_numpy()
+
+    budget = keyed_amounts(budget_df, months, budget_subject_col)
+    actual = pick_columns(actual_data, actual_cols)
+    prev = pick_columns(actual_data, prev_cols or {})
+
+    def aligned(frame):
+        return thousand_yen(frame.reindex(index=keys, columns=months)).to_numpy()
+
+    return derive_monthly(aligned(budget), aligned(actual), aligned(prev), list(subjects), months)
+
+
+def consolidate(monthlies):
+    # 複数拠点の月次結果（aggregate_monthly の戻り値のリスト）を科目キー（表記ゆれ・別名をそろえた normalize_subjects）・月で
+    # 揃えて合算し、差額・比率を計算し直す。科目名は各科目キーが最初に現れた拠点の表記にする
+    # 科目・月はいずれかの拠点にあれば含め、全拠点で欠損の値は欠損のまま
+    labels = {}
+    keyed = []
+    for m in monthlies:
+        keys = normalize_subjects(m.index).to_numpy()
+        for key, label in zip(keys, m.index):
+            labels.setdefault(key, label)
+        frame = m.set_axis(pd.Index(keys, name=KEY_NAME), axis=0)
+        keyed.append(frame[~frame.index.duplicated(keep="first")])
+    months = list(dict.fromkeys(month for m in monthlies for month in m.columns.get_level_values(0)))
+
+    def total(measure):
+        stacked = np.stack([
+            m.xs(measure, axis=1, level=1).reindex(index=list(labels), columns=months).to_numpy(dtype=float)
+            for m in keyed
+        ])
+        return np.where(np.isnan(stacked).all(axis=0), np.nan, np.nansum(stacked, axis=0))
+
+    return derive_monthly(total(BUDGET), total(ACTUAL), total(PREV_ACTUAL), list(labels.values()), months)
+
+
+def flatten(wide, columns=APP_COLUMNS, months=None, label_format="{period}_{label}", blank=""):
+    # 既存の「{月}_{ラベル}」形式の表に変換。欠損は空欄（""）
+    # blank=None なら欠損を <NA>・NaN のまま数値の列で返す（画面の st.dataframe 用。"" と数値が混ざった列は Arrow に変換できない）
+    if months is None:
+        months = list(dict.fromkeys(wide.columns.get_level_values(0)))
+    data = {"科目名": list(wide.index)}
+    for month in months:
+        for measure, label in columns:
+            values = wide[(month, measure)]
+            if measure in AMOUNT_MEASURES or measure in ROLLUP_INT_MEASURES:
+                values = values.astype("Int64")
+            if blank is not None:
+                values = values.astype(object).where(values.notna(), blank)
+            data[label_format.format(period=month, label=label)] = values.to_numpy()
+    return pd.DataFrame(data)
+
+
+# --- 期間集計（四半期・半期・年間など） ---
+def period_groups(months, size=3, prefix="Q", start=None):
+    # 月リストを size か月ずつに区切った {期間ラベル: [月, ...]}。start で期首月をずらせる
+    months = list(months)
+    if start is not None and start in months:
+        i = months.index(start)
+        months = months[i:] + months[:i]
+    return {f"{prefix}{n // size + 1}": months[n:n + size] for n in range(0, len(months), size)}
+
+
+def quarter_groups(months, fiscal_start=FISCAL_START):
+    # 期首月から3か月ずつの四半期（予算ファイルの月の並びが期首から始まっていなくても期首月でそろえる）
+    return period_groups(months, size=3, prefix="Q", start=month_label(fiscal_start))
+
+
+def rollup(monthly, groups):
+    # 月次結果（aggregate_monthly の戻り値）を期間ごとに合算する
+    # groups: {期間ラベル: [月, ...]}。期間の重なりや任意の区切りも可（月×期間の0/1行列との積で一括計算）
+    months = list(dict.fromkeys(monthly.columns.get_level_values(0)))
+    periods = list(groups)
+    indicator = np.zeros((len(months), len(periods)))
+    pos = {m: i for i, m in enumerate(months)}
+    for j, period in enumerate(periods):
+        for m in groups[period]:
+            if m in pos:
+                indicator[pos[m], j] = 1.0
+    budget = monthly.xs(BUDGET, axis=1, level=1)[months].to_numpy(dtype=float)
+    actual = monthly.xs(ACTUAL, axis=1, level=1)[months].to_numpy(dtype=float)
+
+    budget_sum = np.nan_to_num(budget) @ indicator
+    actual_sum = np.nan_to_num(actual) @ indicator
+    month_count = (~np.isnan(actual)).astype(float) @ indicator
+    period_len = indicator.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        has_budget = budget_sum != 0
+        avg = np.where(month_count > 0, actual_sum / month_count, 0)
+        blocks = {
+            BUDGET_TOTAL: np.where(has_budget, budget_sum, np.nan),
+            ACTUAL_TOTAL: np.where(actual_sum != 0, actual_sum, np.nan),
+            DIFF: np.where(has_budget, actual_sum - budget_sum, np.nan),
+            RATE: np.where(has_budget, np.round(actual_sum / budget_sum * 100, 1), np.nan),
+            ACTUAL_MONTHS: month_count,
+            # 見込み: 実績のある月の単純平均 × 期間の月数
+            FORECAST: np.where(avg != 0, np.round(avg * period_len), np.nan),
+        }
+    stacked = np.stack([blocks[m] for m in ROLLUP_MEASURES], axis=2).reshape(len(monthly), len(periods) * len(ROLLUP_MEASURES))
+    columns = pd.MultiIndex.from_product([periods, ROLLUP_MEASURES], names=["期間", "計測値"])
+    return pd.DataFrame(stacked, index=monthly.index, columns=columns)
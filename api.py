@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+import sga_scan
+from aggregation import AMOUNT_MEASURES, ROLLUP_INT_MEASURES, quarter_groups
+from fact_store import default_store
+from incremental import IncrementalAggregator, LoadError, input_manifest
+from instrumentation import Recorder
+from preview import Memo
+from subject_index import normalize_subjects
+from upload_store import UploadStore
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # pyarrow がなければ JSON だけ返す
+    pa = None
+
+# 集計結果の HTTP API（ローカル用）
+# 月次・四半期・年間・販管費明細を JSON（既定）か Arrow IPC ストリームで返す。集計は app.py・予実集計.py と同じ差分集計・ファクト表を使う
+# ETag は入力ファイルの内容ハッシュ・資源・条件から作るので、入力が変わらないかぎり If-None-Match の再取得は 304 で済み、集計し直さない
+#   GET /                          拠点と資源の一覧
+#   GET /monthly?period=4月,5月&subject=売上高
+#   GET /quarterly?from=Q1&to=Q2
+#   GET /annual
+#   GET /sga?pct=10&abs=100000&top=20   （しきい値を指定すると超えたものだけ。指定しなければ全明細）
+# 共通の条件: entity（拠点。1つだけなら省略可）、format=json|arrow（Accept: application/vnd.apache.arrow.stream でも可）
+HOST = os.environ.get("YOJITSU_API_HOST", "127.0.0.1")
+PORT = int(os.environ.get("YOJITSU_API_PORT", "8765"))
+
+# app.py の保存先（フォルダを指定しなければこれを返す）
+APP_BUDGET_PATH = os.path.join("budget", "予算保存用.xlsx")
+APP_ACTUAL_DIR = "actuals"
+APP_ENTITY = "app"
+
+JSON_MIME = "application/json; charset=utf-8"
+ARROW_MIME = "application/vnd.apache.arrow.stream"
+FORMATS = {"json": JSON_MIME, "arrow": ARROW_MIME}
+# 資源: 期間の列名
+RESOURCES = {"monthly": "月", "quarterly": "期間", "annual": "期間", "sga": "月"}
+PARAMS = {"entity", "period", "from", "to", "subject", "format", "pct", "abs", "top"}
+# 返した本文を保持する数（ETag ごと）
+BODY_CACHE_SIZE = 64
+
+# name: 拠点名（URL の entity）、budget_path: 予算ファイル、list_actuals: 実績ファイルのパス一覧を返す関数、
+# aggregator: 使う IncrementalAggregator、fact_entity: ファクト表での拠点名
+Source = namedtuple("Source", ["name", "budget_path", "list_actuals", "aggregator", "fact_entity"])
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _values(params, name):
+    # 繰り返し・カンマ区切りのどちらでも受け付ける
+    return [v.strip() for raw in params.get(name, []) for v in raw.split(",") if v.strip()]
+
+
+def _number(params, name, cast):
+    values = _values(params, name)
+    if not values:
+        return None
+    try:
+        return cast(values[-1])
+    except ValueError:
+        raise RequestError(400, f"{name} は数値で指定してください: {values[-1]}")
+
+
+def select_periods(labels, params):
+    # period（列挙）・from〜to（範囲）で絞った期間。指定がなければすべて
+    labels = list(labels)
+    periods = _values(params, "period")
+    bounds = [_values(params, "from")[-1:], _values(params, "to")[-1:]]
+    unknown = [p for p in periods + bounds[0] + bounds[1] if p not in labels]
+    if unknown:
+        raise RequestError(400, f"期間が見つかりません: {unknown}（指定できる期間: {labels}）")
+    if periods:
+        labels = [p for p in labels if p in periods]
+    start = labels.index(bounds[0][0]) if bounds[0] and bounds[0][0] in labels else 0
+    end = labels.index(bounds[1][0]) + 1 if bounds[1] and bounds[1][0] in labels else len(labels)
+    return labels[start:end]
+
+
+def subject_mask(subjects, params):
+    # subject（科目名。表記ゆれは科目キーでそろえる）で絞る行の真偽値。指定がなければすべて
+    wanted = _values(params, "subject")
+    if not wanted:
+        return None
+    return normalize_subjects(list(subjects)).isin(set(normalize_subjects(wanted))).to_numpy()
+
+
+def period_records(wide, level_name, periods, mask):
+    # (期間, 計測値) の列を持つ表を「科目名・期間・各計測値」の1行1科目×期間の表にする
+    if mask is not None:
+        wide = wide[mask]
+    parts = []
+    for period in periods:
+        part = wide[period].copy()
+        part.insert(0, level_name, period)
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns=["科目名", level_name])
+    frame = pd.concat(parts).reset_index()
+    frame.columns.name = None
+    for col in frame.columns:
+        if col in AMOUNT_MEASURES or col in ROLLUP_INT_MEASURES:
+            frame[col] = frame[col].round().astype("Int64")
+    return frame
+
+
+def encode(frame, fmt, meta):
+    # 戻り値: (本文, Content-Type)
+    if fmt == "arrow":
+        if pa is None:
+            raise RequestError(406, "Arrow 形式で返すには pyarrow が必要です（format=json を使ってください）")
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), b"yojitsu": json.dumps(meta, ensure_ascii=False).encode("utf-8")}
+        )
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW_MIME
+    rows = frame.to_json(orient="records", force_ascii=False)
+    head = json.dumps(meta, ensure_ascii=False)
+    return f'{head[:-1]}, "rows": {rows}}}'.encode("utf-8"), JSON_MIME
+
+
+class ResultService:
+    # HTTP に依存しない部分（拠点の解決・ETag・集計結果と本文のキャッシュ）
+    def __init__(self, sources):
+        self.sources = {s.name: s for s in sources}
+        # 拠点・入力の版ごとの集計結果（同じ版の同時要求は1回だけ計算する）
+        self._results = Memo(max_entries=2 * len(self.sources))
+        self._bodies = Memo(max_entries=BODY_CACHE_SIZE)
+
+    def source(self, params):
+        names = _values(params, "entity")
+        if not names:
+            if len(self.sources) == 1:
+                return next(iter(self.sources.values()))
+            raise RequestError(400, f"entity を指定してください: {list(self.sources)}")
+        if names[-1] not in self.sources:
+            raise RequestError(404, f"拠点が見つかりません: {names[-1]}（{list(self.sources)}）")
+        return self.sources[names[-1]]
+
+    def tables(self, source, manifest):
+        # 入力の版が変わった拠点の古い結果は捨てる
+        self._results.discard(lambda key: key[0] == source.name and key[1] != manifest)
+        return self._results.get((source.name, manifest), lambda: self._compute(source))
+
+    def _compute(self, source):
+        recorder = Recorder("api")
+        try:
+            actual_paths = list(source.list_actuals())
+            with recorder.stage("差分集計"):
+                result = source.aggregator.run(source.budget_path, actual_paths, recorder=recorder)
+            months = result.months
+            quarterly = source.aggregator.rollup("四半期", quarter_groups(months), recorder=recorder)
+            annual = source.aggregator.rollup("年間", {"年間": months}, recorder=recorder)
+            fiscal_year = result.resolver.fiscal_year
+            with recorder.stage("ファクト同期", rows=len(actual_paths)):
+                default_store.sync(source.fact_entity, source.budget_path, actual_paths,
+                                   fiscal_year=fiscal_year, recorder=recorder)
+            with recorder.stage("販管費明細チェック") as stage:
+                token, compute = sga_scan.metrics_source(default_store, source.fact_entity, fiscal_year, months)
+                sga = sga_scan.default_memo.get(token, compute)
+                stage.rows = len(sga)
+        finally:
+            recorder.flush()
+        return {"fiscal_year": fiscal_year, "monthly": result.monthly, "quarterly": quarterly, "annual": annual,
+                "sga": sga}
+
+    def _build(self, source, manifest, resource, params, fmt):
+        tables = self.tables(source, manifest)
+        level_name = RESOURCES[resource]
+        if resource == "sga":
+            metrics = tables["sga"]
+            periods = select_periods(dict.fromkeys(metrics["月"]), params)
+            frame = metrics[metrics["月"].isin(periods).to_numpy()]
+            mask = subject_mask(frame["科目名"], params)
+            if mask is not None:
+                frame = frame[mask]
+            thresholds = [_number(params, "pct", float), _number(params, "abs", float), _number(params, "top", int)]
+            if any(v is not None for v in thresholds):
+                defaults = sga_scan.ScanThresholds()
+                frame = sga_scan.exceptions(
+                    frame.reset_index(drop=True),
+                    sga_scan.ScanThresholds(*[d if v is None else v for v, d in zip(thresholds, defaults)]),
+                )
+            else:
+                frame = frame.reset_index(drop=True)
+                for col in sga_scan.AMOUNT_COLUMNS:
+                    if col in frame.columns:
+                        frame[col] = frame[col].round().astype("Int64")
+        else:
+            wide = tables[resource]
+            periods = select_periods(dict.fromkeys(wide.columns.get_level_values(0)), params)
+            frame = period_records(wide, level_name, periods, subject_mask(wide.index, params))
+        meta = {"entity": source.name, "resource": resource, "fiscal_year": tables["fiscal_year"], "periods": periods}
+        return encode(frame, fmt, meta)
+
+    def respond(self, path, params, accept="", if_none_match=None):
+        # 戻り値: (ステータス, ヘッダーの辞書, 本文)
+        try:
+            resource = path.strip("/")
+            if resource == "":
+                index = {"entities": list(self.sources), "resources": list(RESOURCES), "formats": list(FORMATS)}
+                return 200, {"Content-Type": JSON_MIME}, json.dumps(index, ensure_ascii=False).encode("utf-8")
+            if resource not in RESOURCES:
+                raise RequestError(404, f"資源が見つかりません: /{resource}（{['/' + r for r in RESOURCES]}）")
+            unknown = sorted(set(params) - PARAMS)
+            if unknown:
+                raise RequestError(400, f"指定できない条件です: {unknown}（{sorted(PARAMS)}）")
+            fmt = (_values(params, "format") or ["arrow" if ARROW_MIME in accept else "json"])[-1]
+            if fmt not in FORMATS:
+                raise RequestError(400, f"format は {list(FORMATS)} のいずれかです: {fmt}")
+            source = self.source(params)
+            # ETag は入力の内容ハッシュと条件だけで決まる（集計はしない）
+            manifest = input_manifest(source.budget_path, list(source.list_actuals()))
+            query = sorted((k, tuple(_values(params, k))) for k in params)
+            raw = json.dumps([source.name, manifest, resource, query, fmt], ensure_ascii=False)
+            etag = '"' + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32] + '"'
+            headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+            if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+                return 304, headers, b""
+            body, mime = self._bodies.get(etag, lambda: self._build(source, manifest, resource, params, fmt))
+            return 200, {**headers, "Content-Type": mime}, body
+        except RequestError as e:
+            status, message = e.status, str(e)
+        except LoadError as e:
+            status, message = 503, f"読込エラー({e.path}): {e.error}"
+        except Exception as e:
+            status, message = 500, f"{type(e).__name__}: {e}"
+        return status, {"Content-Type": JSON_MIME}, json.dumps({"error": message}, ensure_ascii=False).encode("utf-8")
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # エンコードせずに送られた日本語（UTF-8 のまま）は http.server が latin-1 として読むので戻す
+            try:
+                raw = self.path.encode("latin-1").decode("utf-8")
+            except UnicodeError:
+                raw = self.path
+            url = urlsplit(raw)
+            status, headers, body = service.respond(
+                url.path, parse_qs(url.query), self.headers.get("Accept", ""), self.headers.get("If-None-Match"),
+            )
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def app_source():
+    # app.py でアップロードされたファイル（全科目の差分集計の状態は app.py と共有する）
+    actuals = UploadStore(APP_ACTUAL_DIR, "api_actuals")
+    return Source(APP_ENTITY, APP_BUDGET_PATH, actuals.paths, IncrementalAggregator("app_all"), APP_ENTITY)
+
+
+def main(argv=None):
+    # app.py と並べて、または単独で実行する
+    parser = argparse.ArgumentParser(description="集計結果を JSON・Arrow で返すローカルの HTTP サーバー")
+    parser.add_argument("directories", nargs="*",
+                        help=f"拠点のフォルダ（省略時は app.py の保存先: {APP_BUDGET_PATH} と {APP_ACTUAL_DIR} フォルダ）")
+    parser.add_argument("--budget", default=None, help="各フォルダの予算ファイル名（既定は予実集計.py と同じ）")
+    parser.add_argument("--pattern", default=None, help="各フォルダの実績ファイル名のパターン（既定は予実集計.py と同じ）")
+    parser.add_argument("--host", default=HOST, help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=PORT, help="待ち受けるポート")
+    args = parser.parse_args(argv)
+
+    if args.directories:
+        import 予実集計 as batch
+
+        sources = []
+        for directory in args.directories:
+            entity = batch.Entity(os.path.basename(os.path.normpath(os.path.abspath(directory))), directory,
+                                  args.budget or batch.BUDGET_FILE, args.pattern or batch.ACTUAL_PATTERN)
+            budget_path, _ = batch.entity_inputs(entity)
+            # ファクト表は予実集計.py と共有し、差分集計は前年実績も読む API 用の状態にする
+            sources.append(Source(
+                entity.name, budget_path, lambda entity=entity: batch.entity_inputs(entity)[1],
+                IncrementalAggregator(f"api_{batch.state_name(directory)}"), batch.state_name(directory),
+            ))
+    else:
+        sources = [app_source()]
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(ResultService(sources)))
+    print(f"http://{args.host}:{args.port}/ で待ち受けます: {[s.name for s in sources]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
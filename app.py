@@ -1,31 +1,138 @@
+import os
+import time
+
+# 再実行ごとの、スクリプトの開始から画面を出すまでの時間の基準
+SCRIPT_STARTED = time.perf_counter()
+
 import streamlit as st
-import pandas as pd
-import io
+from instrumentation import TRACE_MEMORY, Recorder
+from upload_store import FILES_LOCK, UploadStore, entry_label
 
-def to_thousand_yen(x):
-    try:
-        return round(float(x) / 1000)
-    except:
-        return ""
+# 画面に出す科目
+NEEDED_SUBJECTS = ["売上高", "売上総利益", "販売費及び一般管理費", "経常利益"]
+# アップロードファイルの保存先（内容が変わったときだけ書き込み、一覧は目録から引く）
+BUDGET_DIR = "budget"
+BUDGET_FILE = "予算保存用.xlsx"
+BUDGET_SAVE_PATH = os.path.join(BUDGET_DIR, BUDGET_FILE)
+ACTUAL_DIR = "actuals"
+# 入力ファイルの版ごとに保持する集計結果の数（主要指標・全科目の新旧）
+RESULT_CACHE_SIZE = 4
+# ファクト表での拠点名（年度・月をまたぐ比較はファクト表から引く）
+FACT_ENTITY = "app"
+# プレビューのカードの月見出し・実績の色（選択順に繰り返す）
+MONTH_COLORS = ["#2b7cff", "#00b383"]
 
-def main():
-    st.markdown("""
+# 固定の見出し・説明（スクリプトはコンパイル済みのものが再実行に使われるので、文字列は作り直されない）
+HEADER = """
 # 予算・実績 自動集計システム
 ---
-""")
-
-    with st.expander("❓ 使い方ガイド", expanded=True):
-        st.markdown("""
+"""
+GUIDE = """
         1. **予算ファイル（1つ）・実績ファイル（複数）をアップロード**
         2. 保存済みファイルの確認や削除も可能
         3. ファイルが揃うと自動で集計・プレビュー
         4. 集計結果はExcelでダウンロードできます
-        """)
+        """
+PREVIEW_NOTE = (
+    "<div style='background-color:#f0f2f6;border-radius:8px;padding:10px 16px 10px 16px;margin-bottom:8px;'>"
+    "<b>アップロード済みのファイルに基づき、選択した月の主要指標を集計しています。月を切り替えても計算済みの月はそのまま表示します。</b>"
+    "</div>"
+)
+
+
+@st.cache_resource
+def upload_stores():
+    # 保存先はプロセスに1つだけ作り、全セッションで共有する（アップロード画面に要るのはこれだけなので先に作る）
+    # 予算ファイルは専用のフォルダに置く（スクリプトのフォルダは他のファイルの書き込みで更新日時が変わり、目録を走査し直すことになる）
+    os.makedirs(ACTUAL_DIR, exist_ok=True)
+    os.makedirs(BUDGET_DIR, exist_ok=True)
+    if os.path.exists(BUDGET_FILE) and not os.path.exists(BUDGET_SAVE_PATH):
+        # 以前の保存先（スクリプトのフォルダ直下）にある予算ファイルを移す
+        os.replace(BUDGET_FILE, BUDGET_SAVE_PATH)
+    return UploadStore(BUDGET_DIR, "budget", pattern=BUDGET_FILE), UploadStore(ACTUAL_DIR, "actuals")
+
+
+BUDGET_STORE, ACTUAL_STORE = upload_stores()
+
+
+@st.cache_resource
+def shared_resources():
+    # 差分計算の状態・集計結果のキャッシュはプロセスに1つだけ作り、全セッションで共有する
+    # （このスクリプトは再実行のたびに読み直されるので、モジュール変数のままではセッション・再実行ごとに作り直される）
+    # 集計のモジュール（pandas・pyarrow など）は最初に要るときに読み込む
+    from incremental import IncrementalAggregator
+    from preview import Memo
+
+    return (
+        IncrementalAggregator("app", subjects=NEEDED_SUBJECTS),
+        # カードを全科目で表示するときの集計（選ばれたときだけ実行する）
+        IncrementalAggregator("app_all"),
+        Memo(max_entries=RESULT_CACHE_SIZE),
+    )
+
+
+@st.cache_resource
+def background_watcher():
+    # 実績フォルダを監視し、ファイルが置かれたら画面を開く前に差分集計を済ませておく（プロセスに1つ）
+    from fact_store import default_store as fact_store
+    from watcher import WatchTarget, Watcher
+
+    app_aggregator, all_aggregator, _ = shared_resources()
+    target = WatchTarget(
+        "app", BUDGET_SAVE_PATH, ACTUAL_STORE.paths, [app_aggregator, all_aggregator], [ACTUAL_DIR, BUDGET_DIR],
+        facts=(fact_store, FACT_ENTITY),
+    )
+    return Watcher([target]).start()
+
+
+def shared_run(name, aggregator, actual_paths, recorder):
+    # 同じ入力の集計は全セッションで1回だけ行って結果を共有する（計算中に来た同じ要求は結果を待つ）
+    # 入力が変わればキーが変わるので、古い版の結果は捨てる
+    from incremental import input_manifest
+
+    result_cache = shared_resources()[2]
+    with FILES_LOCK.read():
+        manifest = input_manifest(BUDGET_SAVE_PATH, actual_paths)
+        result_cache.discard(lambda key: key[0] == name and key[1] != manifest)
+        return result_cache.get(
+            (name, manifest), lambda: aggregator.run(BUDGET_SAVE_PATH, actual_paths, recorder=recorder),
+        )
+
+
+def new_recorder():
+    # 段階ごとの時間・行数を記録し、画面下部の診断表示と timings.jsonl に出す
+    # （診断表示を開いているときはピークメモリも測る）
+    return Recorder("app", trace_memory=TRACE_MEMORY or st.session_state.get("show_diagnostics", False))
+
+
+def diagnostics(rows):
+    if rows and st.toggle("🩺 診断情報（処理時間・メモリ）を表示", key="show_diagnostics"):
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+
+
+def main():
+    # アップロード・管理の画面を先に出し、集計の準備（モジュールの読込・差分計算の状態の読込）はその後に行う
+    recorder = new_recorder()
+    try:
+        saved_actual_files = render_inputs(recorder)
+        recorder.record("初回表示", time.perf_counter() - SCRIPT_STARTED)
+        with recorder.stage("監視の開始"):
+            background_watcher()
+    finally:
+        page_rows = recorder.frame_rows()
+        recorder.flush()
+    if saved_actual_files:
+        results(saved_actual_files, page_rows)
+    else:
+        diagnostics(page_rows)
+
 
-    import os
-    BUDGET_SAVE_PATH = "予算保存用.xlsx"
-    actual_dir = "actuals"
-    os.makedirs(actual_dir, exist_ok=True)
+def render_inputs(recorder):
+    # 戻り値: 予算・実績が揃っていれば保存済みの実績ファイルのパス、揃っていなければ None
+    st.markdown(HEADER)
+
+    with st.expander("❓ 使い方ガイド", expanded=True):
+        st.markdown(GUIDE)
 
 
     # --- ファイルアップロードUI ---
@@ -34,423 +141,256 @@ def main():
         with col1:
             st.subheader("予算ファイル")
             budget_file = st.file_uploader("予算ファイルをアップロード", type=["xlsx"], key="budget")
-            use_saved_budget = os.path.exists(BUDGET_SAVE_PATH)
+            use_saved_budget = BUDGET_FILE in BUDGET_STORE.entries()
             if use_saved_budget:
                 st.success(f"現在の予算ファイル: {BUDGET_SAVE_PATH}")
             if budget_file:
-                with open(BUDGET_SAVE_PATH, "wb") as f:
-                    f.write(budget_file.getbuffer())
-                st.success(f"予算ファイルを保存しました: {BUDGET_SAVE_PATH}")
+                # 前回と同じ内容なら書き込み・解析を省く
+                with recorder.stage("アップロード保存", rows=1):
+                    entry, written = BUDGET_STORE.save(BUDGET_FILE, budget_file.getbuffer())
+                if entry["error"]:
+                    st.error(f"予算ファイル読込エラー: {entry['error']}")
+                if written:
+                    st.success(f"予算ファイルを保存しました: {BUDGET_SAVE_PATH}")
                 use_saved_budget = True
         with col2:
             st.subheader("実績ファイル（複数可）")
             actual_file = st.file_uploader("実績ファイルをアップロード", type=["xlsx"], accept_multiple_files=True, key="actual")
             if actual_file:
-                for afile in actual_file:
-                    save_path = os.path.join(actual_dir, afile.name)
-                    with open(save_path, "wb") as f:
-                        f.write(afile.getbuffer())
-                st.success(f"{len(actual_file)}件の実績ファイルを保存しました。")
+                written_count = 0
+                # 書き込みの排他（FILES_LOCK）は内容が変わったファイルを書くときだけ save の中で取る
+                with recorder.stage("アップロード保存", rows=len(actual_file)):
+                    for afile in actual_file:
+                        entry, written = ACTUAL_STORE.save(afile.name, afile.getbuffer())
+                        written_count += written
+                        if entry["error"]:
+                            st.error(f"実績ファイル読込エラー({ACTUAL_STORE.path(afile.name)}): {entry['error']}")
+                if written_count:
+                    st.success(f"{written_count}件の実績ファイルを保存しました。")
 
         st.markdown("---")
-        saved_actual_files = [os.path.join(actual_dir, f) for f in os.listdir(actual_dir) if f.endswith(".xlsx")]
-        st.info(f"保存済み実績ファイル: {[os.path.basename(f) for f in saved_actual_files]}")
+        actual_entries = ACTUAL_STORE.entries()
+        saved_actual_files = [ACTUAL_STORE.path(name) for name in actual_entries]
+        # 年月は保存時に検出して目録に持っている値を使う（ファイルは読み直さない）
+        st.info(f"保存済み実績ファイル: {[entry_label(name, entry) for name, entry in actual_entries.items()]}")
         if saved_actual_files:
             st.subheader("実績ファイルの削除")
-            files_to_delete = st.multiselect("削除したい実績ファイルを選択", [os.path.basename(f) for f in saved_actual_files])
+            files_to_delete = st.multiselect(
+                "削除したい実績ファイルを選択", list(actual_entries),
+                format_func=lambda name: entry_label(name, actual_entries[name]),
+            )
             if st.button("選択したファイルを削除"):
-                for fname in files_to_delete:
-                    fpath = os.path.join(actual_dir, fname)
-                    if os.path.exists(fpath):
-                        os.remove(fpath)
+                with FILES_LOCK.write():
+                    for fname in files_to_delete:
+                        ACTUAL_STORE.remove(fname)
                 st.success(f"{len(files_to_delete)}件のファイルを削除しました。画面を再読み込みしてください。")
         st.markdown("---")
 
-    if use_saved_budget and saved_actual_files:
-        st.success("ファイルがアップロードされました。自動集計を開始します。")
-        st.markdown("---")
-        st.subheader("集計結果プレビュー（4月・5月のみ）")
-        st.markdown(
-            "<div style='background-color:#f0f2f6;border-radius:8px;padding:10px 16px 10px 16px;margin-bottom:8px;'>"
-            "<b>アップロード済みのファイルに基づき、4月・5月の主要指標を集計しています。下記テーブルは横スクロール・高さ制限付きで閲覧できます。</b>"
-            "</div>",
-            unsafe_allow_html=True
-        )
-        # 集計処理開始（デバッグ表示削除済み）
-        # 予算データ読込
-        try:
-            budget_df = pd.read_excel(BUDGET_SAVE_PATH, skiprows=6)
-            # st.write("DEBUG: 予算データ読み込み", budget_df.head())
-        except Exception as e:
-            st.error(f"予算ファイル読込エラー: {e}")
-            return
-        budget_subject_col = [col for col in budget_df.columns if '科目' in str(col)]
+    return saved_actual_files if use_saved_budget and saved_actual_files else None
 
-        if budget_subject_col:
-            budget_subject_col = budget_subject_col[0]
 
+@st.fragment
+def results(saved_actual_files, page_rows):
+    # 集計結果の画面だけの部分再実行（月・ページ・しきい値などを変えてもアップロード画面は作り直さない）
+    recorder = new_recorder()
+    try:
+        render_results(recorder, saved_actual_files)
+    finally:
+        rows = recorder.frame_rows()
+        recorder.flush()
+    diagnostics(page_rows + rows)
+
+
+def render_results(recorder, saved_actual_files):
+    # 集計・表示のモジュールはアップロード画面を出した後に読み込む（2回目以降はすでに読み込まれたものを使う）
+    import card_renderer
+    import forecast
+    import sga_scan
+    from aggregation import flatten, quarter_groups
+    from fact_store import default_store as fact_store
+    from incremental import LoadError
+    from ingest import format_timings
+    from period_index import RANGE_COLUMNS, PeriodIndex
+    from preview import card_row, cached_view, other_year_block, table as preview_table
+    from report_writer import XLSX_MIME, lazy_report
+
+    app_aggregator, all_aggregator, _ = shared_resources()
+    st.success("ファイルがアップロードされました。自動集計を開始します。")
+    st.markdown("---")
+    st.subheader("集計結果プレビュー")
+    st.markdown(PREVIEW_NOTE, unsafe_allow_html=True)
+    # 集計処理開始（デバッグ表示削除済み）
+    # 集計（同じ入力なら他のセッションの結果を使う。変更のあったファイルに関係する月だけ再計算し、読込は列指向ストアから）
+    try:
+        with recorder.stage("差分集計"):
+            result = shared_run("app", app_aggregator, saved_actual_files, recorder)
+    except LoadError as e:
+        if e.path == BUDGET_SAVE_PATH:
+            st.error(f"予算ファイル読込エラー: {e.error}")
         else:
-            st.error(f"予算ファイルに科目名列が見つかりません: {budget_df.columns.tolist()}")
-            return
-        months = [col for col in budget_df.columns if col not in [budget_subject_col, 'Unnamed: 13']]
-        # デバッグ用出力（削除済み）
-        # 実績データ読込
-        actual_data = {}
-        import re
-        for afile in saved_actual_files:
-            try:
-                df = pd.read_excel(afile, skiprows=6)
-                # デバッグ用出力（削除済み）
-            except Exception as e:
-                st.error(f"実績ファイル読込エラー({afile}): {e}")
-                return
-            col_candidates = [col for col in df.columns if '科目' in str(col).replace(' ', '').replace('　', '')]
-
-            if col_candidates:
-                subject_col = col_candidates[0]
-
-            else:
-                st.error(f"実績ファイルに科目名列が見つかりません: {df.columns.tolist()}")
-                return
-            # インデックス正規化
-            df[subject_col] = df[subject_col].astype(str).str.strip().str.replace(' ', '').str.replace('　', '')
-            df = df.set_index(subject_col)
-
-            m = re.search(r'PL_(\d{4})年(\d{1,2})月', os.path.basename(afile))
-            if m:
-                month = f"{int(m.group(2))}月"
-            else:
-                month = os.path.basename(afile)
-
-            actual_data[month] = df
-        # 実績カラム名マッピング
-        actual_file_map = {}
-        actual_col_map = {}
-        for k, df in actual_data.items():
-            for month in months:
-                found = False
-                for col in df.columns:
-                    if '2025年' in col and month in col and '実績金額(発生)' in col:
-                        actual_file_map[month] = k
-                        actual_col_map[month] = col
-                        found = True
-                        break
-                if not found:
-                    for col in df.columns:
-                        if '2024年' in col and month in col and '実績金額(発生)' in col:
-                            actual_file_map[month] = k
-                            actual_col_map[month] = col
-                            break
-        # 集計
-        # 必要な科目名だけ抽出
-        needed_subjects = ["売上高", "売上総利益", "販売費及び一般管理費", "経常利益"]
-        result = []
-        # 予算ファイルにある全科目名を取得
-        all_subjects = list(budget_df[budget_subject_col].unique())
-        # 必要な科目が抜けていれば追加
-        for subj in needed_subjects:
-            if subj not in all_subjects:
-                all_subjects.append(subj)
-        # 月ごとの前年科目名マッピング
-        prev_actual_col_map = {}
-        for k, df in actual_data.items():
-            for month in months:
-                for col in df.columns:
-                    if '2024年' in col and month in col and '実績金額(発生)' in col:
-                        prev_actual_col_map[(month, k)] = col
-        for subject in needed_subjects:
-            row = {"科目名": subject}
-            for month in months:
-                # 予算
-                budget = budget_df.loc[budget_df[budget_subject_col] == subject, month].values[0] if subject in list(budget_df[budget_subject_col]) else ""
-                # 実績（当年）
-                actual = ""
-                # 実績ファイル・カラムがあれば取得（なければ空欄）
-                if month in actual_file_map and month in actual_col_map:
-                    df = actual_data[actual_file_map[month]]
-                    col = actual_col_map[month]
-                    # インデックスに完全一致しない場合、stripや全角半角・空白除去で部分一致を試みる
-                    subject_norm = subject.strip().replace(' ', '').replace('　', '').replace('および', '及び')
-                    matched_index = None
-                    for idx in df.index:
-                        idx_norm = str(idx).strip().replace(' ', '').replace('　', '').replace('および', '及び')
-                        if subject_norm == idx_norm:
-                            matched_index = idx
-                            break
-                    if matched_index is not None:
-                        try:
-                            actual = df.at[matched_index, col]
-                        except:
-                            actual = ""
-                    else:
-                        actual = ""
-                # 実績（前年）
-                prev_actual = ""
-                if (month, actual_file_map.get(month, None)) in prev_actual_col_map:
-                    prev_df = actual_data[actual_file_map[month]]
-                    prev_col = prev_actual_col_map[(month, actual_file_map[month])]
-                    subject_norm = subject.strip().replace(' ', '').replace('　', '')
-                    matched_index = None
-                    for idx in prev_df.index:
-                        idx_norm = str(idx).strip().replace(' ', '').replace('　', '')
-                        if subject_norm == idx_norm:
-                            matched_index = idx
-                            break
-                    if matched_index is not None:
-                        try:
-                            prev_actual = prev_df.at[matched_index, prev_col]
-                        except Exception as e:
-                            st.error(f"前年実績データ取得エラー: {e}")
-                            prev_actual = ""
-                budget_ = to_thousand_yen(budget)
-                actual_ = to_thousand_yen(actual)
-                prev_actual_ = to_thousand_yen(prev_actual)
-                diff = "" if budget_ == "" or actual_ == "" else actual_ - budget_
-                rate = "" if budget_ in ["", 0] or actual_ == "" else round(actual_ / budget_ * 100, 1)
-                yoy = "" if prev_actual_ in ["", 0] or actual_ == "" else round(actual_ / prev_actual_ * 100, 1)
-                row[f"{month}_予算"] = budget_
-                row[f"{month}_実績"] = actual_
-                row[f"{month}_対予算比%"] = rate
-                row[f"{month}_前年比%"] = yoy
-                row[f"{month}_差額"] = diff
-            result.append(row)
-        result_df = pd.DataFrame(result)
-
-        # 原価率・販管費率の計算
-        def safe_div(num, denom):
-            try:
-                if denom in ["", 0, None] or num in ["", None]:
-                    return ""
-                if (isinstance(num, float) and math.isnan(num)) or (isinstance(denom, float) and math.isnan(denom)):
-                    return ""
-                return f"{round(float(num) / float(denom) * 100, 1)}%"
-            except:
-                return ""
-        def safe_zero(x):
-            return 0 if x in ["", None] else x
-        summary_rows = []
-        # サマリー用カラムをDataFrameに必ず追加
-        for month in months:
-            if f"{month}_原価率%" not in result_df.columns:
-                result_df[f"{month}_原価率%"] = ""
-            if f"{month}_販管費率%" not in result_df.columns:
-                result_df[f"{month}_販管費率%"] = ""
-        # サマリー行用の全カラムで空文字初期化
-        all_columns = list(result_df.columns)
-        genka_row = {col: "" for col in all_columns}
-        han_kan_row = {col: "" for col in all_columns}
-        genka_row["科目名"] = "原価率(%)"
-        han_kan_row["科目名"] = "販管費率(%)"
-        for month in months:
-            if f"{month}_実績" in result_df.columns:
-                try:
-                    sales = safe_zero(result_df[result_df["科目名"] == "売上高"][f"{month}_実績"].values[0])
-                    gross_profit = safe_zero(result_df[result_df["科目名"] == "売上総利益"][f"{month}_実績"].values[0])
-                    cost = sales - gross_profit
-                    vals = result_df[result_df["科目名"] == "販売費及び一般管理費"][f"{month}_実績"].values
-                    sg_and_a = vals[0] if len(vals) > 0 and vals[0] not in [None, "", 0] else 0
-                    genka = safe_div(cost, sales)
-                    han_kan = safe_div(sg_and_a, sales)
-                    genka_row[f"{month}_原価率%"] = genka
-                    han_kan_row[f"{month}_販管費率%"] = han_kan
-                    # 4月・5月の実績列にも値を入れる
-                    if month in ["4月", "5月"]:
-                        genka_row[f"{month}_実績"] = genka
-                        han_kan_row[f"{month}_実績"] = han_kan
-                except Exception as e:
-                    genka_row[f"{month}_原価率%"] = ""
-                    han_kan_row[f"{month}_販管費率%"] = ""
-        # 経常利益の直後（index=4,5）にサマリー行を挿入
-        keijou_idx = result_df.index[result_df["科目名"] == "経常利益"].tolist()
-        if keijou_idx:
-            insert_at = keijou_idx[0] + 1
-        else:
-            insert_at = 4
-        # サマリー行をresult_df.columns順に並べてから挿入
-        summary_df = pd.DataFrame([genka_row, han_kan_row])[result_df.columns]
-        result_df = pd.concat([
-            result_df.iloc[:insert_at],
-            summary_df,
-            result_df.iloc[insert_at:]
-        ], ignore_index=True)
-
-        # 4月・5月のみのカラムを抽出し、「原価率%」「販管費率%」カラムは除外
-        keep_months = ["4月", "5月"]
-        keep_cols = ["科目名"]
-        for m in keep_months:
-            keep_cols += [c for c in result_df.columns if c.startswith(m+"_") and not (c.endswith("原価率%") or c.endswith("販管費率%"))]
-        # カラムを絞り込む
-        result_df = result_df[keep_cols]
-        # --- 販売費及び一般管理費の明細分析 ---
-        # 5月の実績データから「販売費及び一般管理費」配下のみ抽出
-        sg_subject = "販売費及び一般管理費"
-        may_file = actual_file_map.get("5月", None)
-        may_col = actual_col_map.get("5月", None)
-        apr_file = actual_file_map.get("4月", None)
-
-        def render_card(subject, row4, row5):
-            icon_map = {
-                '売上高': '💸',
-                '売上総利益': '📈',
-                '販売費及び一般管理費': '💼',
-                '経常利益': '📈',
-                '原価率(%)': '⚙️',
-                '販管費率(%)': '🧾',
-            }
-            badge = ''
-            if subject in ['売上高', '経常利益']:
-                badge = '<span style="background:#ffd700;color:#444;font-size:0.85em;padding:2px 8px 2px 8px;border-radius:10px;margin-left:8px;">重要</span>'
-            icon = icon_map.get(subject, '')
-            def format_block(label, value, color, is_rate=False, is_diff=False):
-                empty = (value is None or value == '' or value == 'None')
-                # 色は全て黒（#222）、ただし差額でマイナスのみ赤
-                base_color = '#222'
-                if is_diff and not empty:
-                    try:
-                        v = float(value)
-                        if v < 0:
-                            base_color = '#ff1744'  # 鮮やかな赤
-                    except:
-                        pass
-                style = f"background:{'#f0f5fa' if empty else '#fff'};border-radius:8px;padding:8px 12px;margin-bottom:3px;min-width:90px;box-shadow:0 1px 3px #e3e8f0;"
-                val_style = f"font-size:1.25rem;font-weight:bold;color:{'#aaa' if empty else base_color};display:flex;align-items:center;gap:2px;"
-                label_style = "font-size:0.93rem;color:#555;letter-spacing:0.01em;"
-                # 金額系はカンマ区切り
-                if not empty and not is_rate:
-                    try:
-                        val = f"{int(float(value)):,}"
-                    except:
-                        val = value
-                else:
-                    val = value if not empty else "-"
-                # 率系は%を強調
-                if is_rate and not empty:
-                    val = f"{value}<span style='font-size:1.08rem;color:{base_color};margin-left:2px;'>%</span>"
-                return f'<div style="{style}"><div style="{label_style}">{label}</div><div style="{val_style}">{val}</div></div>'
-            return f'<div class="card-hover" style="border-radius:13px;padding:22px 18px 18px 18px;margin-bottom:22px;background:linear-gradient(90deg,#eaf2fb 60%,#f8faff 100%);box-shadow:0 3px 12px #a3bffa18;max-width:560px;margin-left:auto;margin-right:auto;"><div style="font-size:1.17rem;font-weight:700;color:#28427a;margin-bottom:12px;letter-spacing:0.01em;display:flex;align-items:center;gap:6px;">{icon} {subject}{badge}</div><div class="card-flex"><div style="flex:1;min-width:170px;"><div style="font-size:1.01rem;color:#2b7cff;font-weight:600;margin-bottom:4px;">4月</div>{format_block('実績', row4.get('実績'), '#2b7cff')}{format_block('予算', row4.get('予算'), '#28427a')}{format_block('差額', row4.get('差額'), '#c0392b', is_diff=True)}{format_block('対予算比', row4.get('対予算比'), '#1abc9c', is_rate=True)}{format_block('前年比', row4.get('前年比'), '#8e44ad', is_rate=True)}</div><div style="flex:1;min-width:170px;"><div style="font-size:1.01rem;color:#00b383;font-weight:600;margin-bottom:4px;">5月</div>{format_block('実績', row5.get('実績'), '#00b383')}{format_block('予算', row5.get('予算'), '#28427a')}{format_block('差額', row5.get('差額'), '#c0392b', is_diff=True)}{format_block('対予算比', row5.get('対予算比'), '#1abc9c', is_rate=True)}{format_block('前年比', row5.get('前年比'), '#8e44ad', is_rate=True)}</div></div></div>'
-        # --- CSSを1回だけグローバルに出す ---
-        st.markdown("""
-        <style>
-        .card-flex {display:flex;gap:18px;justify-content:space-between;flex-wrap:wrap;}
-        @media (max-width: 600px) { .card-flex {flex-direction:column;gap:8px;} }
-        .card-hover:hover {box-shadow:0 6px 24px #6a8cff33;transform:translateY(-2px);transition:0.2s;}
-        </style>
-        """, unsafe_allow_html=True)
-        # 指標ごとにカードで表示
-        html_cards = ""
-        for idx, row in result_df.iterrows():
-            subject = row["科目名"]
-            row4 = {
-                '実績': row.get('4月_実績', ''),
-                '予算': row.get('4月_予算', ''),
-                '差額': row.get('4月_差額', ''),
-                '対予算比': row.get('4月_対予算比%', ''),
-                '前年比': row.get('4月_前年比%', ''),
-            }
-            row5 = {
-                '実績': row.get('5月_実績', ''),
-                '予算': row.get('5月_予算', ''),
-                '差額': row.get('5月_差額', ''),
-                '対予算比': row.get('5月_対予算比%', ''),
-                '前年比': row.get('5月_前年比%', ''),
-            }
-            html_cards += render_card(subject, row4, row5)
-        # st.write("DEBUG: html_cards 内容", html_cards)
-        html = "<div style='display:grid;gap:8px;'>" + html_cards + "</div>"
-        if html_cards.strip():
-            st.markdown(html, unsafe_allow_html=True)
-        # st.write("DEBUG: st.markdown(unsafe_allow_html=True) 実行済み")
-        st.markdown(":blue[↓ 集計結果をExcelでダウンロード ↓]")
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            result_df.to_excel(writer, index=False)
-        st.download_button(
-            label="集計結果をExcelでダウンロード",
-            data=output.getvalue(),
-            file_name="月次予実表集計結果.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True,
-            type="primary"
+            st.error(f"実績ファイル読込エラー({e.path}): {e.error}")
+        return
+    with st.expander("⏱ ファイル読込時間", expanded=False):
+        st.text("\n".join(format_timings(result.timings)) or "変更のあったファイルはありません")
+    months = result.months
+    monthly = result.monthly
+    # 実績カラム名マッピング（見出しを (年度, 月, 計測値) に解析して辞書で引く）
+    actual_cols = result.resolver.current_map(months)
+    # --- 表示する年度・月の選択（選んだ月だけ計算し、月ごとに結果を保持する） ---
+    fiscal_years = result.resolver.fiscal_years() or [result.resolver.fiscal_year]
+    if len(fiscal_years) > 1:
+        preview_year = st.selectbox("年度", fiscal_years, format_func=lambda y: f"{y}年度", key="preview_year")
+    else:
+        preview_year = fiscal_years[0]
+    is_current_year = preview_year == result.resolver.fiscal_year
+    year_resolver = result.resolver.for_year(preview_year)
+    year_cols = actual_cols if is_current_year else {
+        m: hit for m in months if (hit := year_resolver.lookup(preview_year, m)) is not None
+    }
+    selected = st.multiselect(
+        "表示する月", months, default=[m for m in months if m in year_cols] or months[:1],
+        key=f"preview_months_{preview_year}",
+    )
+    selected = [m for m in months if m in selected]
+    # カードに出す科目（主要指標か、予算ファイルの全科目か）
+    card_scope = st.radio("カードの対象", ["主要指標", "全科目"], horizontal=True, key="card_scope")
+    scope_result = result
+    if card_scope == "全科目":
+        try:
+            with recorder.stage("差分集計(全科目)"):
+                scope_result = shared_run("app_all", all_aggregator, saved_actual_files, recorder)
+        except LoadError as e:
+            st.error(f"全科目の集計エラー({e.path}): {e.error}")
+    scope_subjects = NEEDED_SUBJECTS if scope_result is result else list(scope_result.monthly.index)
+
+    def month_source(month):
+        # (月の版, 1か月分の計測値を返す関数)。当年度は差分集計の結果、それ以外の年度は実績列だけから作る
+        if is_current_year:
+            return scope_result.revisions[month], lambda: scope_result.monthly[month]
+        return other_year_block(year_resolver, month, scope_subjects)
+
+    with recorder.stage("表示用整形", rows=len(selected)):
+        tokens = {}
+        views = {}
+        for month in selected:
+            tokens[month], block_fn = month_source(month)
+            views[month] = cached_view(tokens[month], block_fn)
+        result_df = preview_table(views)
+
+    # --- CSSを1回だけグローバルに出す ---
+    st.markdown(card_renderer.CSS, unsafe_allow_html=True)
+    # 指標ごとにカードで表示（科目グループで絞り込み、表示中のページの分だけ作る）
+    groups = card_renderer.subject_groups(list(result_df["科目名"]))
+    card_subjects = list(result_df["科目名"])
+    if len(card_subjects) > card_renderer.PAGE_SIZES[0]:
+        col1, col2 = st.columns(2)
+        with col1:
+            group = st.selectbox("科目グループ", [card_renderer.ALL_GROUPS, *groups], key="card_group")
+        with col2:
+            page_size = st.selectbox(
+                "1ページの表示件数", card_renderer.PAGE_SIZES,
+                index=card_renderer.PAGE_SIZES.index(card_renderer.DEFAULT_PAGE_SIZE), key="card_page_size",
+            )
+        if group != card_renderer.ALL_GROUPS:
+            card_subjects = groups.get(group, [])
+    else:
+        page_size = card_renderer.DEFAULT_PAGE_SIZE
+    page_subjects, n_pages, page = card_renderer.paginate(card_subjects, 1, page_size)
+    if n_pages > 1:
+        page = st.number_input(f"ページ（全{n_pages}ページ・{len(card_subjects)}科目）", min_value=1, max_value=n_pages, value=1, step=1, key="card_page")
+        page_subjects, n_pages, page = card_renderer.paginate(card_subjects, page, page_size)
+    with recorder.stage("カード生成", rows=len(page_subjects)):
+        colors = {month: MONTH_COLORS[i % len(MONTH_COLORS)] for i, month in enumerate(selected)}
+        html_cards = [
+            card_renderer.cached_card(
+                subject, [(month, card_row(views[month], subject), colors[month]) for month in selected]
+            )
+            for subject in page_subjects
+        ]
+    if html_cards:
+        st.markdown(card_renderer.grid(html_cards), unsafe_allow_html=True)
+    st.markdown(":blue[↓ 集計結果をExcelでダウンロード ↓]")
+    # ブックはボタンが押されたときだけ作る（同じ集計結果なら作成済みのものを使う）
+    report = lazy_report({"月次予実表": result_df})
+
+    def build_report():
+        # ボタンが押されたときに呼ばれるので、出力の記録は別に書き出す
+        export_recorder = Recorder("app")
+        with export_recorder.stage("Excel出力", rows=len(result_df)):
+            data = report()
+        export_recorder.flush()
+        return data
+
+    st.download_button(
+        label="集計結果をExcelでダウンロード",
+        data=build_report,
+        file_name="月次予実表集計結果.xlsx",
+        mime=XLSX_MIME,
+        use_container_width=True,
+        type="primary"
+    )
+    st.markdown("---")
+
+    # --- 期間指定集計（年度累計・四半期・直近nか月・任意期間。累積和の差で求める） ---
+    st.markdown("#### 期間指定集計")
+    with recorder.stage("期間索引", rows=len(monthly)):
+        period_index = PeriodIndex(monthly)
+    last_month = period_index.last_actual_month() or months[-1]
+    preset = st.radio("集計期間", ["年度累計", "四半期", "直近3か月", "直近6か月", "直近12か月", "任意期間"], horizontal=True, key="range_preset")
+    if preset == "年度累計":
+        start, end = months[0], last_month
+    elif preset == "四半期":
+        quarters = quarter_groups(months)
+        quarter = st.selectbox("四半期", list(quarters), key="range_quarter")
+        start, end = quarters[quarter][0], quarters[quarter][-1]
+    elif preset.startswith("直近"):
+        window = int(preset.removeprefix("直近").removesuffix("か月"))
+        start, end = period_index.rolling_start(window, last_month), last_month
+    else:
+        start, end = st.select_slider("期間", options=months, value=(months[0], last_month), key="range_custom")
+    range_df = flatten(period_index.ranges({f"{start}〜{end}": (start, end)}), RANGE_COLUMNS, label_format="{label}",
+                       blank=None)
+    st.caption(f"{start}〜{end} の合計（千円）。直近nか月は年度の範囲内で集計します。")
+    st.dataframe(range_df, use_container_width=True, hide_index=True)
+    st.markdown("---")
+
+    # --- 年間見込み（カードの対象と同じ科目を行列でまとめて推計する） ---
+    st.markdown("#### 年間見込み")
+    method = st.radio("残りの月の見込み方", forecast.METHODS, horizontal=True, key="forecast_method")
+    with recorder.stage("年間見込み", rows=len(scope_result.monthly)):
+        landing_df = forecast.landing_table(forecast.forecast(scope_result.monthly), method=method, blank=None)
+    st.caption("実績のない月を選んだ方式で見込んだ年間の合計（千円）。前年実績・予算のない科目は実績ペースで見込みます。")
+    st.dataframe(landing_df, use_container_width=True, hide_index=True)
+    st.markdown("---")
+
+    # --- 販売費及び一般管理費の明細チェック（全月の前年比・前月比・予算差を一度に計算し、しきい値超えを影響額順に表示） ---
+    st.markdown("#### 販売費及び一般管理費の明細チェック")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        scan_pct = st.number_input("変動率のしきい値（±%）", min_value=0.0, max_value=1000.0, value=10.0, step=5.0, key="sga_pct")
+    with col2:
+        scan_abs = st.number_input("金額差のしきい値（円）", min_value=0, value=0, step=10000, key="sga_abs")
+    with col3:
+        scan_top = st.number_input("表示件数（上位）", min_value=1, max_value=1000, value=50, step=10, key="sga_top")
+    try:
+        # ファクト表に変わったファイルの分だけ入れ、予算・実績・前年同月・前月の値をSQLでまとめて引く
+        with recorder.stage("ファクト同期", rows=len(saved_actual_files)), FILES_LOCK.read():
+            fact_store.sync(FACT_ENTITY, BUDGET_SAVE_PATH, saved_actual_files,
+                            fiscal_year=result.resolver.fiscal_year, recorder=recorder)
+        with recorder.stage("販管費明細チェック") as stage:
+            token, compute = sga_scan.metrics_source(fact_store, FACT_ENTITY, result.resolver.fiscal_year, months)
+            metrics = sga_scan.default_memo.get(token, compute)
+            exceptions_df = sga_scan.exceptions(metrics, sga_scan.ScanThresholds(scan_pct, scan_abs, scan_top))
+            stage.rows = len(metrics)
+    except Exception as e:
+        st.error(f"販管費明細の読込エラー: {e}")
+    else:
+        st.caption(
+            f"役員報酬〜雑費の{metrics['科目名'].nunique()}科目×{metrics['月'].nunique()}か月から、"
+            f"前年比・前月比・対予算比が100%±{scan_pct:g}%以上かつ金額差{scan_abs:,}円以上のものを影響額の大きい順に表示します。"
         )
-        st.markdown("---")
+        st.dataframe(exceptions_df, use_container_width=True, hide_index=True)
 
-        # --- 販売費及び一般管理費の明細ピックアップ（月別・前年比/前月比110%以上・90%以下） ---
-        for target_month, target_file, target_col, prev_col in [
-            ("4月", actual_file_map.get("4月", None), actual_col_map.get("4月", None), None),
-            ("5月", actual_file_map.get("5月", None), actual_col_map.get("5月", None), prev_actual_col_map.get(("5月", actual_file_map.get("5月", None)), None))
-        ]:
-            pick_rows = []
-            if target_file and target_col:
-                df = actual_data[target_file]
-                # 前年データは5月のみ
-                df_prev = actual_data[target_file] if prev_col and target_month == "5月" else None
-                # 前月データ（4月はなし）
-                df_prev_month = actual_data[actual_file_map.get("4月", None)] if target_month == "5月" and actual_file_map.get("4月", None) else None
-                prev_month_col = actual_col_map.get("4月", None) if target_month == "5月" else None
-                # 役員報酬～雑費の範囲だけピックアップ
-                idx_list = list(df.index)
-                try:
-                    start_idx = idx_list.index("役員報酬")
-                    end_idx = idx_list.index("雑費")
-                    if start_idx > end_idx:
-                        detail_subjects = []
-                    else:
-                        detail_subjects = idx_list[start_idx:end_idx+1]
-                except ValueError:
-                    detail_subjects = []
-                for subject in detail_subjects:
-                    try:
-                        val = df.at[subject, target_col]
-                        # 前年比（5月のみ）
-                        if target_month == "5月" and df_prev is not None and prev_col and subject in df_prev.index:
-                            prev_val = df_prev.at[subject, prev_col]
-                            yoy = round(float(val) / float(prev_val) * 100, 1) if prev_val not in [None, "", 0] and val not in [None, "", 0] else None
-                        else:
-                            yoy = None
-                        # 前月比（5月のみ）
-                        if target_month == "5月" and df_prev_month is not None and prev_month_col and subject in df_prev_month.index:
-                            prev_month_val = df_prev_month.at[subject, prev_month_col]
-                            mom = round(float(val) / float(prev_month_val) * 100, 1) if prev_month_val not in [None, "", 0] and val not in [None, "", 0] else None
-                        else:
-                            mom = None
-                        pick_rows.append({
-                            "科目名": subject,
-                            "金額": f"{int(float(val)):,}" if val not in [None, "", 0] else None,
-                            "前年比": yoy,
-                            "前月比": mom
-                        })
-                    except:
-                        continue
-            # 高い順・低い順でソート
-            if pick_rows:
-                df_pick = pd.DataFrame(pick_rows)
-                st.markdown(f"#### 販売費及び一般管理費の明細（{target_month}） 前年比・前月比ピックアップ")
-                col1, col2 = st.columns(2)
-                with col1:
-                    if target_month == "4月":
-                        st.markdown("**金額が110%以上**")
-                        df_over_110 = df_pick[(df_pick["金額"].notnull()) & (df_pick["金額"].apply(lambda x: int(str(x).replace(',', '')) if x not in [None, "", 0] else 0) >= 110)]
-                        st.dataframe(df_over_110.sort_values("金額", ascending=False)[["科目名", "金額"]], use_container_width=True)
-                        st.markdown("**金額が90%以下**")
-                        df_under_90 = df_pick[(df_pick["金額"].notnull()) & (df_pick["金額"].apply(lambda x: int(str(x).replace(',', '')) if x not in [None, "", 0] else 0) <= 90)]
-                        st.dataframe(df_under_90.sort_values("金額", ascending=True)[["科目名", "金額"]], use_container_width=True)
-                    else:
-                        st.markdown("**前年比が110%以上**")
-                        df_over_110 = df_pick[(df_pick["前年比"].notnull()) & (df_pick["前年比"] >= 110)]
-                        st.dataframe(df_over_110.sort_values("前年比", ascending=False)[["科目名", "金額", "前年比", "前月比"]], use_container_width=True)
-                        st.markdown("**前年比が90%以下**")
-                        df_under_90 = df_pick[(df_pick["前年比"].notnull()) & (df_pick["前年比"] <= 90)]
-                        st.dataframe(df_under_90.sort_values("前年比", ascending=True)[["科目名", "金額", "前年比", "前月比"]], use_container_width=True)
-                with col2:
-                    if target_month == "4月":
-                        st.markdown("")
-                    else:
-                        st.markdown("**前月比が110%以上**")
-                        df_mom_over_110 = df_pick[(df_pick["前月比"].notnull()) & (df_pick["前月比"] >= 110)]
-                        st.dataframe(df_mom_over_110.sort_values("前月比", ascending=False)[["科目名", "金額", "前年比", "前月比"]], use_container_width=True)
-                        st.markdown("**前月比が90%以下**")
-                        df_mom_under_90 = df_pick[(df_pick["前月比"].notnull()) & (df_pick["前月比"] <= 90)]
-                        st.dataframe(df_mom_under_90.sort_values("前月比", ascending=True)[["科目名", "金額", "前年比", "前月比"]], use_container_width=True)
 
 if __name__ == "__main__":
     main()
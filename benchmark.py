@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import columnar_store
+import synthetic_pl
+from aggregation import APP_COLUMNS, flatten
+from fact_store import FactStore
+from incremental import IncrementalAggregator
+from instrumentation import Recorder
+import 予実集計 as batch
+
+# 性能測定
+# 合成した予算・実績ファイルで 予実集計.py の1拠点分の処理（run_entity）をそのまま実行し、
+# 初回（列指向ストア・差分集計の状態なし）と変更なしの2回目の処理段階（読込・列対応・集計・期間集計・Excel出力）ごとの
+# 所要時間を測り、結果を1行1件の JSON で追記する。同じ条件の前回結果と比べて遅くなった段階を表示する
+ACTUAL_PATTERN = "PL_*.xlsx"  # 合成データの実績ファイル（前年度分を含む）
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.jsonl")
+SLOWDOWN_RATIO = 1.2  # 前回比でこれ以上遅くなった段階を知らせる
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        self.seconds.setdefault(stage, []).append(time.perf_counter() - start)
+        return value
+
+
+def _clear_outputs(entity, state_dir):
+    # 初回の測定の前に、前回の実行で作られた列指向ストア・差分集計の状態・出力ブックを消す
+    budget_path, actual_paths = batch.entity_inputs(entity)
+    for path in [budget_path, *actual_paths]:
+        store = columnar_store.store_path(path)
+        if os.path.exists(store):
+            os.remove(store)
+    IncrementalAggregator(batch.state_name(entity.directory), state_dir=state_dir).reset()
+    report_path = os.path.join(entity.directory, batch.REPORT_FILE)
+    if os.path.exists(report_path):
+        os.remove(report_path)
+
+
+def _run_entity(timer, label, entity, state_dir, store):
+    # 予実集計.py の1拠点分の処理（run_entity）をそのまま実行し、段階ごとの時間を「label:段階」で記録する
+    recorder = Recorder("benchmark", log_path=None)
+    result = batch.run_entity(entity, recorder=recorder, state_dir=state_dir, store=store)
+    if not result.ok:
+        raise RuntimeError(f"{entity.name}: {result.error}")
+    for r in recorder.flush():
+        timer.seconds.setdefault(f"{label}:{r.stage}", []).append(r.seconds)
+    timer.seconds.setdefault(f"{label}:全体", []).append(result.seconds)
+    return result
+
+
+def run_once(datasets, timer, work):
+    # 繰り返しごとにファクト表を作り直し、前回の列指向ストア・状態も消して初回（キャッシュなし）から測る
+    run_dir = tempfile.mkdtemp(prefix="run_", dir=work)
+    state_dir = os.path.join(run_dir, "state")
+    store = FactStore(os.path.join(run_dir, "facts.sqlite3"))
+    for name, (budget_path, actual_paths) in datasets.items():
+        entity = batch.Entity(name, os.path.dirname(budget_path), os.path.basename(budget_path), ACTUAL_PATTERN)
+        _clear_outputs(entity, state_dir)
+        result = _run_entity(timer, "初回", entity, state_dir, store)
+        # app.py の表示用の表（月次結果は予実集計.py と同じ差分集計の結果）
+        timer.run("表示用整形", flatten, result.monthly, APP_COLUMNS)
+        _run_entity(timer, "変更なし", entity, state_dir, store)
+
+
+def summarize(seconds):
+    return {
+        stage: {"median": statistics.median(values), "min": min(values), "runs": len(values)}
+        for stage, values in seconds.items()
+    }
+
+
+def previous_result(path, params):
+    last = None
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("params") == params:
+                last = record
+    return last
+
+
+def report(record, previous):
+    lines = [f"{'段階':<16}{'中央値(秒)':>12}{'最小(秒)':>12}{'前回比':>10}"]
+    for stage, stats in record["stages"].items():
+        ratio = ""
+        before = (previous or {}).get("stages", {}).get(stage)
+        if before and before["median"] > 0:
+            r = stats["median"] / before["median"]
+            ratio = f"{r:.2f}x" + (" 遅化" if r >= SLOWDOWN_RATIO else "")
+        lines.append(f"{stage:<16}{stats['median']:>12.4f}{stats['min']:>12.4f}{ratio:>10}")
+    if previous:
+        lines.append(f"（比較対象: {previous.get('revision')} {previous.get('timestamp')}）")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="予実集計の処理段階ごとの性能測定")
+    parser.add_argument("--subjects", type=int, default=60, help="科目数")
+    parser.add_argument("--months", type=int, default=12, help="年度あたりの月数")
+    parser.add_argument("--years", type=int, default=1, help="実績の年度数")
+    parser.add_argument("--entities", type=int, default=1, help="拠点数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=RESULTS_PATH, help="結果の追記先（JSON Lines）")
+    parser.add_argument("--no-save", action="store_true", help="結果を保存しない")
+    args = parser.parse_args(argv)
+
+    params = {"subjects": args.subjects, "months": args.months, "years": args.years, "entities": args.entities}
+    with tempfile.TemporaryDirectory(prefix="yojitsu_bench_") as work:
+        start = time.perf_counter()
+        datasets = synthetic_pl.generate(
+            os.path.join(work, "data"), n_subjects=args.subjects, n_months=args.months,
+            n_years=args.years, n_entities=args.entities, seed=args.seed,
+        )
+        print(f"合成データ作成: {time.perf_counter() - start:.2f}秒（{params}）")
+        timer = StageTimer()
+        for _ in range(args.repeat):
+            run_once(datasets, timer, work)
+
+    record = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "params": params,
+        "repeat": args.repeat,
+        "stages": summarize(timer.seconds),
+    }
+    previous = previous_result(args.output, params)
+    print(report(record, previous))
+    if not args.no_save:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return record
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
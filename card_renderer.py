@@ -0,0 +1,142 @@
+import math
+
+from preview import COST_RATIO, SGA_RATIO, Memo
+from subject_index import normalize_subject
+
+# プレビューのカード表示
+# カード・月の欄・値の欄のHTMLは最初に一度だけ組み立てた雛形に値を差し込むだけで作る
+# カード1枚のHTMLは表示する値（科目・月・色・実績/予算/差額/対予算比/前年比）をキーに作り置きし、
+# 画面にはグループで絞り込んだ科目のうち表示中のページの分だけを出す（科目数が増えても1回の描画量は一定）
+PAGE_SIZES = [6, 12, 24, 48]
+DEFAULT_PAGE_SIZE = 12
+ALL_GROUPS = "すべて"
+RATIO_GROUP = "比率"
+# 科目の並び（損益計算書の順）をこの科目の直後で区切ってグループにする
+GROUP_ENDS = [
+    ("売上総利益", "売上・売上原価"),
+    ("販売費及び一般管理費", "販売費及び一般管理費"),
+    ("経常利益", "営業損益・営業外損益"),
+]
+LAST_GROUP = "特別損益・その他"
+RATIO_SUBJECTS = [COST_RATIO, SGA_RATIO]
+
+ICONS = {
+    "売上高": "💸",
+    "売上総利益": "📈",
+    "販売費及び一般管理費": "💼",
+    "経常利益": "📈",
+    COST_RATIO: "⚙️",
+    SGA_RATIO: "🧾",
+}
+BADGE_SUBJECTS = ["売上高", "経常利益"]
+BADGE = '<span style="background:#ffd700;color:#444;font-size:0.85em;padding:2px 8px 2px 8px;border-radius:10px;margin-left:8px;">重要</span>'
+
+# 値の欄の色は全て黒（#222）、ただし差額でマイナスのみ赤
+VALUE_COLOR = "#222"
+NEGATIVE_COLOR = "#ff1744"
+EMPTY_COLOR = "#aaa"
+
+# --- 雛形（モジュール読込時に一度だけ作る） ---
+_block = (
+    '<div style="background:{background};border-radius:8px;padding:8px 12px;margin-bottom:3px;min-width:90px;box-shadow:0 1px 3px #e3e8f0;">'
+    '<div style="font-size:0.93rem;color:#555;letter-spacing:0.01em;">{label}</div>'
+    '<div style="font-size:1.25rem;font-weight:bold;color:{color};display:flex;align-items:center;gap:2px;">{value}</div></div>'
+).format
+_rate = "{value}<span style='font-size:1.08rem;color:{color};margin-left:2px;'>%</span>".format
+_month = (
+    '<div style="flex:1;min-width:170px;">'
+    '<div style="font-size:1.01rem;color:{color};font-weight:600;margin-bottom:4px;">{month}</div>{blocks}</div>'
+).format
+_card = (
+    '<div class="card-hover" style="border-radius:13px;padding:22px 18px 18px 18px;margin-bottom:22px;'
+    'background:linear-gradient(90deg,#eaf2fb 60%,#f8faff 100%);box-shadow:0 3px 12px #a3bffa18;max-width:560px;'
+    'margin-left:auto;margin-right:auto;">'
+    '<div style="font-size:1.17rem;font-weight:700;color:#28427a;margin-bottom:12px;letter-spacing:0.01em;'
+    'display:flex;align-items:center;gap:6px;">{icon} {subject}{badge}</div>'
+    '<div class="card-flex">{months}</div></div>'
+).format
+# (ラベル, 率か, 差額か)
+BLOCKS = [("実績", False, False), ("予算", False, False), ("差額", False, True), ("対予算比", True, False), ("前年比", True, False)]
+
+CSS = """
+        <style>
+        .card-flex {display:flex;gap:18px;justify-content:space-between;flex-wrap:wrap;}
+        @media (max-width: 600px) { .card-flex {flex-direction:column;gap:8px;} }
+        .card-hover:hover {box-shadow:0 6px 24px #6a8cff33;transform:translateY(-2px);transition:0.2s;}
+        </style>
+        """
+
+default_memo = Memo(max_entries=1024)
+
+
+def value_block(label, value, is_rate=False, is_diff=False):
+    empty = value is None or value == "" or value == "None"
+    color = VALUE_COLOR
+    if is_diff and not empty:
+        try:
+            if float(value) < 0:
+                color = NEGATIVE_COLOR
+        except (TypeError, ValueError):
+            pass
+    if empty:
+        text = "-"
+    elif is_rate:
+        # 率系は%を強調
+        text = _rate(value=value, color=color)
+    else:
+        # 金額系はカンマ区切り（原価率などの「12.3%」はそのまま）
+        try:
+            text = f"{int(float(value)):,}"
+        except (TypeError, ValueError):
+            text = value
+    return _block(
+        background="#f0f5fa" if empty else "#fff", label=label, color=EMPTY_COLOR if empty else color, value=text,
+    )
+
+
+def month_block(month, row, color):
+    # row: preview.card_row の戻り値
+    blocks = "".join(value_block(label, row.get(label), is_rate, is_diff) for label, is_rate, is_diff in BLOCKS)
+    return _month(color=color, month=month, blocks=blocks)
+
+
+def card(subject, month_rows):
+    # month_rows: [(月, card_row の戻り値, 色)]
+    months = "".join(month_block(month, row, color) for month, row, color in month_rows)
+    badge = BADGE if subject in BADGE_SUBJECTS else ""
+    return _card(icon=ICONS.get(subject, ""), subject=subject, badge=badge, months=months)
+
+
+def cached_card(subject, month_rows, memo=default_memo):
+    # 表示する値が同じカードは作り直さない
+    key = (subject, tuple((month, tuple(row.items()), color) for month, row, color in month_rows))
+    return memo.get(key, lambda: card(subject, month_rows))
+
+
+def grid(cards):
+    return "<div style='display:grid;gap:8px;'>" + "".join(cards) + "</div>"
+
+
+def subject_groups(subjects):
+    # 戻り値: {グループ名: [科目名]}（科目の並び順のまま。原価率・販管費率は「比率」にまとめる）
+    ends = {normalize_subject(subject): i for i, (subject, _) in enumerate(GROUP_ENDS)}
+    groups = {}
+    position = 0
+    for subject in subjects:
+        if subject in RATIO_SUBJECTS:
+            groups.setdefault(RATIO_GROUP, []).append(subject)
+            continue
+        name = GROUP_ENDS[position][1] if position < len(GROUP_ENDS) else LAST_GROUP
+        groups.setdefault(name, []).append(subject)
+        end = ends.get(normalize_subject(subject))
+        if end is not None and end >= position:
+            position = end + 1
+    return groups
+
+
+def paginate(items, page, page_size):
+    # 戻り値: (そのページの項目, ページ数, 範囲内に収めたページ番号)。ページ番号は1始まり
+    n_pages = max(1, math.ceil(len(items) / page_size))
+    page = min(max(1, int(page)), n_pages)
+    start = (page - 1) * page_size
+    return items[start:start + page_size], n_pages, page
@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from header_parser import parse_header
+from ingest import FileTiming, read_many
+from subject_index import find_subject_column, index_by_subject
+from workbook_cache import default_cache
+
+# 列指向ストア
+# アップロード時にXLSXを一度だけ解析し、科目キーで索引化した表を Parquet として元ファイルの隣に保存する
+# 以後は Parquet から必要な列だけをメモリマップで読む（元のXLSXは監査用にそのまま残す）
+# 金額列は整数円（欠損は <NA>。円未満のある列は float64）、科目名はカテゴリ型で持ち、読込時のメモリを抑える
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow がなければXLSXを直接読む
+    pa = None
+    pq = None
+
+STORE_SUFFIX = ".parquet"
+META_KEY = b"yojitsu"
+STORE_VERSION = 3  # 列の型を変えたら上げる（古い形式のストアは作り直す。3: 小数の金額列を float64 に）
+SKIPROWS = 6
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def available():
+    return pq is not None
+
+
+def _xlsx_cache():
+    # XLSX の読込結果のキャッシュ。Parquet が使えればそれが読込済みの表の保存先なので、pyarrow がないときだけ使う
+    return None if available() else default_cache
+
+
+def store_path(xlsx_path):
+    return os.path.splitext(xlsx_path)[0] + STORE_SUFFIX
+
+
+def compact_amounts(values, ratio=False):
+    # 整数だけの列は Int32（収まらなければ Int64）
+    # 小数を含む列は、比率（前年比など）なら float32、金額（円未満のある予算など）なら値を変えないよう float64 にする
+    numeric = pd.to_numeric(values, errors="coerce").astype("Float64")
+    finite = numeric.dropna()
+    if (finite != finite.round()).any():
+        return numeric.astype(np.float32 if ratio else np.float64)
+    return numeric.astype("Int32" if finite.empty or finite.abs().max() <= INT32_MAX else "Int64")
+
+
+def prepare(df):
+    # 読込直後の表を科目キー索引の表に変換する
+    subject_col = find_subject_column(df.columns)
+    if subject_col is None:
+        raise ValueError(f"科目名列が見つかりません: {df.columns.tolist()}")
+    keyed = index_by_subject(df, subject_col)
+    for col in keyed.columns:
+        if col == "科目名":
+            keyed[col] = keyed[col].astype("category")
+        elif (key := parse_header(col)) is not None:
+            # 年月の見出しを持つ列（予算・実績金額・前年比）
+            keyed[col] = compact_amounts(keyed[col], ratio="比" in key.measure)
+        elif keyed[col].dtype == object and pd.api.types.infer_dtype(keyed[col], skipna=True).startswith("mixed"):
+            # 文字列と数値が混在する列は Parquet に書けないので文字列にそろえる
+            keyed[col] = keyed[col].astype("string")
+    return keyed
+
+
+def _read_meta(path):
+    try:
+        meta = pq.read_schema(path).metadata or {}
+        return json.loads(meta.get(META_KEY, b"{}"))
+    except Exception:
+        return {}
+
+
+def is_fresh(xlsx_path):
+    # Parquet が元のXLSXと同じ内容から作られていれば True
+    path = store_path(xlsx_path)
+    if not available() or not os.path.exists(path):
+        return False
+    meta = _read_meta(path)
+    return meta.get("version") == STORE_VERSION and meta.get("source_sha256") == default_cache.digest(xlsx_path)
+
+
+def write(xlsx_path, keyed):
+    if not available():
+        return None
+    path = store_path(xlsx_path)
+    table = pa.Table.from_pandas(keyed, preserve_index=True)
+    meta = dict(table.schema.metadata or {})
+    meta[META_KEY] = json.dumps({
+        "version": STORE_VERSION,
+        "source": os.path.basename(xlsx_path),
+        "source_sha256": default_cache.digest(xlsx_path),
+        "parsed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }, ensure_ascii=False).encode("utf-8")
+    table = table.replace_schema_metadata(meta)
+    # 読込中のプロセスが書きかけのファイルを見ないよう一時ファイル経由で置き換える
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def ingest(xlsx_path, df=None):
+    # アップロード直後に呼ぶ。解析結果（科目キー索引の表）を返す
+    if df is None:
+        frames, timings = read_many([xlsx_path], executor="thread", cache=_xlsx_cache(), skiprows=SKIPROWS)
+        if timings[0].error is not None:
+            raise timings[0].error
+        df = frames[xlsx_path]
+    keyed = prepare(df)
+    try:
+        write(xlsx_path, keyed)
+    except Exception:
+        # 保存に失敗しても解析結果はそのまま使える（次回はXLSXから読み直す）
+        pass
+    return keyed
+
+
+def read(xlsx_path, columns=None):
+    # 保存済みの Parquet から指定列だけを読む（科目キーのインデックスと科目名列は常に含める）
+    path = store_path(xlsx_path)
+    if columns is not None:
+        names = pq.read_schema(path).names
+        columns = [c for c in dict.fromkeys(["科目名", *columns]) if c in names]
+    table = pq.read_table(path, columns=columns, memory_map=True, use_pandas_metadata=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def columns_of(xlsx_path):
+    # データ本体を読まずに列名だけを返す
+    path = store_path(xlsx_path)
+    index_cols = {"科目キー", "__index_level_0__"}
+    return [c for c in pq.read_schema(path).names if c not in index_cols]
+
+
+def load_many(paths, columns=None, executor="thread"):
+    # 戻り値: ({パス: 科目キー索引の表}, [FileTiming, ...])
+    # Parquet が最新のファイルはそこから読み、古い・未作成のファイルはXLSXを読んで Parquet を作り直す
+    frames = {}
+    timings = {}
+    stale = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            fresh = is_fresh(path)
+        except OSError as e:
+            timings[path] = FileTiming(path, None, time.perf_counter() - start, 0, False, e)
+            continue
+        if not fresh:
+            stale.append(path)
+            continue
+        try:
+            df = read(path, None if columns is None else columns.get(path))
+            frames[path] = df
+            timings[path] = FileTiming(path, "parquet", time.perf_counter() - start, len(df), True, None)
+        except Exception:
+            stale.append(path)
+
+    if stale:
+        raw, raw_timings = read_many(stale, executor=executor, cache=_xlsx_cache(), skiprows=SKIPROWS)
+        for t in raw_timings:
+            if t.error is not None:
+                timings[t.path] = t
+                continue
+            start = time.perf_counter()
+            try:
+                df = ingest(t.path, raw[t.path])
+            except ValueError as e:
+                timings[t.path] = t._replace(error=e)
+                continue
+            if columns is not None and columns.get(t.path) is not None:
+                # 作り直したストアは全列を持つが、呼び出し側には指定列だけ渡す
+                df = df[[c for c in dict.fromkeys(["科目名", *columns[t.path]]) if c in df.columns]]
+            frames[t.path] = df
+            timings[t.path] = t._replace(seconds=t.seconds + time.perf_counter() - start)
+
+    return frames, [timings[p] for p in paths if p in timings]
+
+
+def headers_many(paths, executor="thread"):
+    # 戻り値: ({パス: 列名リスト}, [FileTiming, ...])
+    # ストアが最新のファイルはスキーマだけを読み、古い・未作成のファイルは解析してストアを作る
+    headers = {}
+    stale = []
+    for path in paths:
+        try:
+            if is_fresh(path):
+                headers[path] = columns_of(path)
+                continue
+        except Exception:
+            pass
+        stale.append(path)
+    timings = []
+    if stale:
+        frames, timings = load_many(stale, executor=executor)
+        for path, df in frames.items():
+            headers[path] = list(df.columns)
+    return headers, timings
@@ -0,0 +1,434 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import columnar_store
+from aggregation import thousand_yen
+from header_parser import FISCAL_START, FLOW, budget_months, month_number, parse_header
+from instrumentation import NULL_RECORDER
+from subject_index import LABEL_COL, normalize_subjects
+from workbook_cache import default_cache
+
+# 予算・実績のファクト表（SQLite）
+# 読み込んだ予算・実績を (拠点, 年度, 月, 科目キー, 計測値, 金額) の1行1値で保存し、
+# 予算・実績・前年同月・前月の値を年度・月をまたいで1回のSQLでまとめて引く
+# 前年度の実績ファイルを一度読み込んでおけば、当年度のファイルに前年の列がなくても前年同月と比べられる
+# 同期は内容ハッシュの変わったファイルと、その月（年度・月）だけを入れ直す
+DB_PATH = os.environ.get(
+    "YOJITSU_FACT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".yojitsu_cache", "facts.sqlite3")
+)
+SCHEMA_VERSION = 1
+BUDGET = "予算"
+ACTUAL = "実績"
+MAX_CELLS = 200  # 1回のSQLで引く (列, 計測値, 年度, 月) の数
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS facts (
+    entity TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    fiscal_year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    amount REAL NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (entity, measure, fiscal_year, month, subject)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS facts_by_subject ON facts (entity, subject, measure, fiscal_year, month);
+CREATE INDEX IF NOT EXISTS facts_by_source ON facts (entity, source);
+CREATE TABLE IF NOT EXISTS sources (
+    entity TEXT NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    periods TEXT NOT NULL,
+    loaded_at TEXT NOT NULL,
+    PRIMARY KEY (entity, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS subjects (
+    entity TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    label TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (entity, subject)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS entities (
+    entity TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    budget_year INTEGER,
+    subjects_source TEXT
+);
+"""
+TABLES = ["facts", "sources", "subjects", "entities"]
+
+SyncResult = namedtuple("SyncResult", ["changed_paths", "periods", "revision"])
+
+# 前年・前月比較の表の列（計測値, ラベル）
+COMPARISON_COLUMNS = [
+    ("actual", "実績"), ("prior_year", "前年実績"), ("yoy", "前年比"), ("prior_month", "前月実績"), ("mom", "前月比"),
+]
+
+
+def _fiscal_order(period):
+    fiscal_year, month = period
+    return fiscal_year, (month - FISCAL_START) % 12
+
+
+def _flow_columns(columns):
+    # 戻り値: {(年度, 月): 列名}（発生額の列。同じ年月が複数あれば後の列）
+    found = {}
+    for col in columns:
+        key = parse_header(col)
+        if key is not None and key.measure == FLOW and key.fiscal_year is not None:
+            found[(key.fiscal_year, key.month)] = col
+    return found
+
+
+def _newest(actual_paths, periods):
+    # 科目の並び・表示名を取る実績ファイル（最新の年月を持つもの。同じなら後に渡されたもの）
+    # periods: {パス: [(年度, 月), ...]}
+    latest = {p: max(map(_fiscal_order, periods[p]), default=None) for p in actual_paths}
+    latest = {p: order for p, order in latest.items() if order is not None}
+    return max(latest, key=lambda p: (latest[p], actual_paths.index(p))) if latest else None
+
+
+def _amounts(frame, col):
+    values = pd.to_numeric(frame[col], errors="coerce")
+    values = values[~values.index.duplicated(keep="first")].dropna()
+    return values.index.to_numpy(dtype=object), values.to_numpy(dtype=float)
+
+
+def _load(paths, columns):
+    frames, timings = columnar_store.load_many(paths, columns=columns)
+    for t in timings:
+        if t.error is not None:
+            raise t.error
+    return frames
+
+
+class FactStore:
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ready = False
+
+    # --- 接続・スキーマ ---
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        if not self._ready:
+            with self._lock:
+                self._ensure_schema(conn)
+                self._ready = True
+        return conn
+
+    @staticmethod
+    def _ensure_schema(conn):
+        conn.executescript(SCHEMA)
+
+        def outdated():
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            return row is None or int(row[0]) != SCHEMA_VERSION
+
+        if not outdated():
+            return
+        # 形式が変わったら入れ直す（元のファイルから作り直せる）
+        # 同じDBを使う他のプロセスが先に作り直して同期を始めていることがあるので、書き込みの排他を取ってから確かめ直す
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if outdated():
+                for table in TABLES:
+                    conn.execute(f"DELETE FROM {table}")
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- 同期 ---
+    def sync(self, entity, budget_path, actual_paths, fiscal_year=None, recorder=NULL_RECORDER):
+        # 予算・実績ファイルの内容を拠点 entity のファクトとして入れる。変わっていないファイルは読まない
+        # fiscal_year: 予算の年度（省略時は実績のある最新の年度）
+        actual_paths = list(actual_paths)
+        digests = {p: default_cache.digest(p) for p in [budget_path, *actual_paths] if p is not None}
+        conn = self._connect()
+        # 画面の再実行のたびに呼ばれるので、入力が前回の同期から変わっていなければ書き込みの排他を取らずに返す
+        revision = self._unchanged_revision(conn, entity, budget_path, actual_paths, fiscal_year, digests)
+        if revision is not None:
+            return SyncResult([], [], revision)
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = self._sync(conn, entity, budget_path, actual_paths, fiscal_year, digests, recorder)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    @staticmethod
+    def _unchanged_revision(conn, entity, budget_path, actual_paths, fiscal_year, digests):
+        # 入力ファイル（パス・内容ハッシュ）・予算の年度・科目の取得元が前回の同期と同じなら同期番号、違えば None
+        conn.execute("BEGIN")
+        try:
+            known = {
+                path: (kind, sha, [tuple(p) for p in json.loads(periods)])
+                for path, kind, sha, periods in conn.execute(
+                    "SELECT path, kind, sha256, periods FROM sources WHERE entity = ?", (entity,)
+                )
+            }
+            row = conn.execute(
+                "SELECT revision, budget_year, subjects_source FROM entities WHERE entity = ?", (entity,)
+            ).fetchone()
+        finally:
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        revision, budget_year, subjects_source = row
+        expected = {p: (ACTUAL, digests[p]) for p in actual_paths}
+        if budget_path is not None:
+            expected[budget_path] = (BUDGET, digests[budget_path])
+        if {p: (kind, sha) for p, (kind, sha, _) in known.items()} != expected:
+            return None
+        if fiscal_year is not None and budget_year != fiscal_year:
+            return None
+        if _newest(actual_paths, {p: known[p][2] for p in actual_paths}) != subjects_source:
+            return None
+        return revision
+
+    def _sync(self, conn, entity, budget_path, actual_paths, fiscal_year, digests, recorder):
+        known = {
+            path: (kind, sha, [tuple(p) for p in json.loads(periods)])
+            for path, kind, sha, periods in conn.execute(
+                "SELECT path, kind, sha256, periods FROM sources WHERE entity = ?", (entity,)
+            )
+        }
+        row = conn.execute(
+            "SELECT revision, budget_year, subjects_source FROM entities WHERE entity = ?", (entity,)
+        ).fetchone()
+        revision, budget_year, subjects_source = row if row is not None else (0, None, None)
+        loaded_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        # --- 実績: 変わったファイル・消えたファイルが供給していた年月だけ入れ直す ---
+        changed = [p for p in actual_paths if known.get(p, (None, None))[1] != digests[p]]
+        removed = [p for p, (kind, _, _) in known.items() if kind == ACTUAL and p not in digests]
+        periods = set()
+        for p in changed + removed:
+            if p in known:
+                periods.update(known[p][2])
+        headers = {}
+        if changed:
+            with recorder.stage("ファクト見出し読込", rows=len(changed)):
+                got, timings = columnar_store.headers_many(changed)
+            for t in timings:
+                if t.error is not None:
+                    raise t.error
+            headers.update(got)
+            for p in changed:
+                periods.update(_flow_columns(headers[p]))
+        if periods:
+            # 対象の年月を持つファイルを、渡された順に入れる（同じ年月は後のファイルを優先）
+            provided = {p: set(known[p][2]) for p in actual_paths if p not in changed and p in known}
+            provided.update({p: set(_flow_columns(headers[p])) for p in changed})
+            involved = [p for p in actual_paths if provided[p] & periods]
+            missing = [p for p in involved if p not in headers]
+            if missing:
+                got, timings = columnar_store.headers_many(missing)
+                for t in timings:
+                    if t.error is not None:
+                        raise t.error
+                headers.update(got)
+            columns = {
+                p: [col for period, col in _flow_columns(headers[p]).items() if period in periods] for p in involved
+            }
+            with recorder.stage("ファクト登録") as s:
+                frames = _load(involved, columns)
+                conn.executemany(
+                    "DELETE FROM facts WHERE entity = ? AND measure = ? AND fiscal_year = ? AND month = ?",
+                    [(entity, ACTUAL, fy, m) for fy, m in periods],
+                )
+                rows = 0
+                for p in involved:
+                    for (fy, m), col in _flow_columns(headers[p]).items():
+                        if (fy, m) not in periods:
+                            continue
+                        subjects, amounts = _amounts(frames[p], col)
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO facts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            zip([entity] * len(subjects), [ACTUAL] * len(subjects), [fy] * len(subjects),
+                                [m] * len(subjects), subjects, amounts.tolist(), [p] * len(subjects)),
+                        )
+                        rows += len(subjects)
+                s.rows = rows
+        conn.executemany("DELETE FROM sources WHERE entity = ? AND path = ?", [(entity, p) for p in removed])
+        conn.executemany(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (entity, p, ACTUAL, digests[p], json.dumps(sorted(_flow_columns(headers[p]))), loaded_at)
+                for p in changed
+            ],
+        )
+
+        # --- 科目の並び・表示名: 最新の年月を持つ実績ファイルのもの ---
+        file_periods = {p: known[p][2] for p in actual_paths if p not in changed}
+        file_periods.update({p: list(_flow_columns(headers[p])) for p in changed})
+        newest = _newest(actual_paths, file_periods)
+        subjects_changed = newest != subjects_source or newest in changed
+        if subjects_changed:
+            conn.execute("DELETE FROM subjects WHERE entity = ?", (entity,))
+            if newest is not None:
+                frame = _load([newest], {newest: []})[newest]
+                frame = frame[~frame.index.duplicated(keep="first")]
+                labels = frame[LABEL_COL].astype(str).str.strip().to_numpy()
+                conn.executemany(
+                    "INSERT INTO subjects VALUES (?, ?, ?, ?)",
+                    [(entity, key, label, i) for i, (key, label) in enumerate(zip(frame.index, labels))],
+                )
+
+        # --- 予算: 内容か年度が変わったときだけ入れ直す ---
+        if fiscal_year is None:
+            fiscal_year = conn.execute(
+                "SELECT MAX(fiscal_year) FROM facts WHERE entity = ? AND measure = ?", (entity, ACTUAL)
+            ).fetchone()[0]
+        old_budget = [p for p, (kind, _, _) in known.items() if kind == BUDGET]
+        budget_changed = (
+            old_budget != ([budget_path] if budget_path is not None else [])
+            or (budget_path is not None and known[budget_path][1] != digests[budget_path])
+            or budget_year != fiscal_year
+        )
+        if budget_changed:
+            conn.execute("DELETE FROM facts WHERE entity = ? AND measure = ?", (entity, BUDGET))
+            conn.executemany("DELETE FROM sources WHERE entity = ? AND path = ?", [(entity, p) for p in old_budget])
+            if budget_path is not None and fiscal_year is not None:
+                with recorder.stage("ファクト登録(予算)") as s:
+                    names = columnar_store.headers_many([budget_path])[0][budget_path]
+                    months = budget_months(names)
+                    frame = _load([budget_path], {budget_path: months})[budget_path]
+                    rows = 0
+                    for month in months:
+                        subjects, amounts = _amounts(frame, month)
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO facts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            zip([entity] * len(subjects), [BUDGET] * len(subjects), [fiscal_year] * len(subjects),
+                                [month_number(month)] * len(subjects), subjects, amounts.tolist(),
+                                [budget_path] * len(subjects)),
+                        )
+                        rows += len(subjects)
+                    s.rows = rows
+                conn.execute(
+                    "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                    (entity, budget_path, BUDGET, digests[budget_path],
+                     json.dumps([[fiscal_year, month_number(m)] for m in months]), loaded_at),
+                )
+
+        if changed or removed or subjects_changed or budget_changed:
+            revision += 1
+        conn.execute(
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)", (entity, revision, fiscal_year, newest),
+        )
+        return SyncResult(changed + removed, sorted(periods, key=_fiscal_order), revision)
+
+    # --- 参照 ---
+    def revision(self, entity):
+        # 同期で内容が変わるたびに増える番号（画面側のキャッシュキーに使う）
+        row = self._connect().execute("SELECT revision FROM entities WHERE entity = ?", (entity,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def fiscal_years(self, entity, measure=ACTUAL):
+        # 値のある年度（新しい順）
+        rows = self._connect().execute(
+            "SELECT DISTINCT fiscal_year FROM facts WHERE entity = ? AND measure = ? ORDER BY fiscal_year DESC",
+            (entity, measure),
+        )
+        return [fy for (fy,) in rows]
+
+    def subjects(self, entity):
+        # 科目キー → 表示名（最新の実績ファイルの並び順）
+        rows = self._connect().execute(
+            "SELECT subject, label FROM subjects WHERE entity = ? ORDER BY position", (entity,)
+        ).fetchall()
+        return pd.Series([label for _, label in rows], index=pd.Index([s for s, _ in rows], name="科目キー"), dtype=object)
+
+    def cells(self, entity, cells):
+        # cells: [(列名, 計測値, 年度, 月)]。戻り値: index=科目キー、columns=列名（cells の順）の金額（円）
+        names = list(dict.fromkeys(name for name, _, _, _ in cells))
+        found = []
+        conn = self._connect()
+        for start in range(0, len(cells), MAX_CELLS):
+            chunk = cells[start:start + MAX_CELLS]
+            values = ", ".join(["(?, ?, ?, ?)"] * len(chunk))
+            params = [v for cell in chunk for v in cell] + [entity]
+            found.extend(conn.execute(
+                f"WITH req(name, measure, fiscal_year, month) AS (VALUES {values}) "
+                "SELECT req.name, f.subject, f.amount FROM req JOIN facts f "
+                "ON f.entity = ? AND f.measure = req.measure AND f.fiscal_year = req.fiscal_year AND f.month = req.month",
+                params,
+            ).fetchall())
+        if not found:
+            return pd.DataFrame(columns=names, dtype=float)
+        long = pd.DataFrame(found, columns=["name", "subject", "amount"])
+        return long.pivot(index="subject", columns="name", values="amount").reindex(columns=names)
+
+    def comparison(self, entity, fiscal_year, months):
+        # 戻り値: {"budget" / "actual" / "prior_year" / "prior_month": index=科目キー、columns=月 の金額（円）}
+        # 当年度の実績がない月は欠損のまま（前年度の実績では代用しない。ColumnResolver.current と同じ扱い）
+        cells = []
+        for label in months:
+            m = month_number(label)
+            prev = 12 if m == 1 else m - 1
+            cells += [
+                (f"budget:{label}", BUDGET, fiscal_year, m),
+                (f"current:{label}", ACTUAL, fiscal_year, m),
+                (f"prior_year:{label}", ACTUAL, fiscal_year - 1, m),
+                (f"prior_month:{label}", ACTUAL, fiscal_year - 1 if m == FISCAL_START else fiscal_year, prev),
+            ]
+        found = self.cells(entity, cells)
+
+        def part(kind):
+            frame = found[[f"{kind}:{label}" for label in months]]
+            frame.columns = list(months)
+            return frame
+
+        return {
+            "budget": part("budget"), "actual": part("current"),
+            "prior_year": part("prior_year"), "prior_month": part("prior_month"),
+        }
+
+
+def _rate(num, denom):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denom != 0, np.round(num / denom * 100, 1), np.nan)
+
+
+def comparison_table(values, subjects, months):
+    # 前年同月・前月比較の表（千円。科目は subjects の表示名の順）。実績のない月は列を出さない
+    keys = normalize_subjects(subjects).to_numpy()
+    data = {"科目名": list(subjects)}
+    for month in months:
+        block = {k: thousand_yen(values[k].reindex(index=keys)[month]).to_numpy() for k in values}
+        if np.isnan(block["actual"]).all():
+            continue
+        block["yoy"] = _rate(block["actual"], block["prior_year"])
+        block["mom"] = _rate(block["actual"], block["prior_month"])
+        for kind, label in COMPARISON_COLUMNS:
+            column = pd.Series(block[kind])
+            if kind not in ("yoy", "mom"):
+                column = column.astype("Int64")
+            column = column.astype(object)
+            data[f"{month}_{label}"] = column.where(column.notna(), "").to_numpy()
+    return pd.DataFrame(data)
+
+
+default_store = FactStore()
@@ -0,0 +1,99 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from aggregation import ACTUAL, BUDGET, PREV_ACTUAL
+
+# 年間見込み（着地見込み）
+# 全科目の実績・予算・前年実績を科目×月の行列にし、実績のない月を方式ごとに一度に推計する
+#   実績ペース:   実績のある月の平均を実績のない月にも見込む（年間進捗集計の「単純月平均×12」と同じ）
+#   前年季節性:   前年の月別の値に、実績のある月の前年比（実績合計÷同じ月の前年実績合計）をかけて見込む
+#   予算ブレンド: 実績のない月の予算と実績ペースを重み付けして見込む
+# 前年実績・予算のない科目・月は実績ペースで代用し、実績が1か月もない科目は見込みを出さない
+RUN_RATE = "実績ペース"
+SEASONAL = "前年季節性"
+BUDGET_BLEND = "予算ブレンド"
+METHODS = [RUN_RATE, SEASONAL, BUDGET_BLEND]
+BUDGET_WEIGHT = 0.5  # 予算ブレンドの予算の重み（残りは実績ペース）
+
+YTD = "実績累計"
+ANNUAL_BUDGET = "年間予算"
+
+# months: 月の並び、remaining_months: 最後の実績月より後の月
+# landing: 科目×(実績累計, 年間予算, 各方式の見込み)、filled: {方式: 科目×月の行列（実績のある月は実績）}
+ForecastResult = namedtuple("ForecastResult", ["subjects", "months", "remaining_months", "landing", "filled"])
+
+
+def project(actual, budget, prior, budget_weight=BUDGET_WEIGHT):
+    # actual / budget / prior: 科目×月の行列（欠損は NaN）
+    # 戻り値: {方式: 実績のない月を推計で埋めた科目×月の行列}
+    has_actual = ~np.isnan(actual)
+    missing = ~has_actual
+    counts = has_actual.sum(axis=1)
+    actual_sum = np.nansum(actual, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(counts > 0, actual_sum / counts, np.nan)[:, None]
+        run_rate = np.broadcast_to(rate, actual.shape)
+
+        # 実績と前年実績がそろう月だけで前年比をとる
+        paired = has_actual & ~np.isnan(prior)
+        prior_sum = np.where(paired, prior, 0).sum(axis=1)
+        growth = np.where(prior_sum != 0, np.where(paired, actual, 0).sum(axis=1) / prior_sum, np.nan)[:, None]
+        seasonal = np.where(np.isnan(prior) | np.isnan(growth), run_rate, prior * growth)
+
+        blend = np.where(np.isnan(budget), run_rate, budget_weight * budget + (1 - budget_weight) * run_rate)
+
+    return {
+        method: np.where(missing, estimate, actual)
+        for method, estimate in ((RUN_RATE, run_rate), (SEASONAL, seasonal), (BUDGET_BLEND, blend))
+    }
+
+
+def forecast(monthly, prior=None, budget_weight=BUDGET_WEIGHT):
+    # monthly: aggregate_monthly の戻り値（千円）
+    # prior: 前年実績（index=科目、columns=月。省略時は monthly の前年実績）
+    months = list(dict.fromkeys(monthly.columns.get_level_values(0)))
+
+    def matrix(measure):
+        return monthly.xs(measure, axis=1, level=1)[months].to_numpy(dtype=float)
+
+    actual, budget = matrix(ACTUAL), matrix(BUDGET)
+    if prior is None:
+        prior = matrix(PREV_ACTUAL)
+    else:
+        prior = prior.reindex(index=monthly.index, columns=months).to_numpy(dtype=float)
+    filled = project(actual, budget, prior, budget_weight)
+
+    reported = np.flatnonzero(~np.isnan(actual).all(axis=0))
+    remaining = months[reported[-1] + 1:] if len(reported) else list(months)
+    no_actual = np.isnan(actual).all(axis=1)
+    data = {
+        YTD: np.where(no_actual, np.nan, np.nansum(actual, axis=1)),
+        ANNUAL_BUDGET: np.where(np.isnan(budget).all(axis=1), np.nan, np.nansum(budget, axis=1)),
+    }
+    for method, values in filled.items():
+        data[method] = np.where(no_actual, np.nan, np.round(values.sum(axis=1)))
+    landing = pd.DataFrame(data, index=monthly.index)
+    return ForecastResult(list(monthly.index), months, remaining, landing, filled)
+
+
+def _cells(values, blank):
+    column = pd.Series(np.round(values)).astype("Int64")
+    if blank is None:
+        return column.array
+    return column.astype(object).where(column.notna(), blank).to_numpy()
+
+
+def landing_table(result, method=None, blank=""):
+    # 科目名・実績累計・年間予算・各方式の年間見込みの表（千円）。欠損は blank（None なら <NA> のまま。画面表示用）
+    # method を指定すると、その方式の残りの月の見込みを「{月}_見込み」の列で後ろに付ける
+    data = {"科目名": result.subjects}
+    for col in [YTD, ANNUAL_BUDGET, *METHODS]:
+        label = col if col in (YTD, ANNUAL_BUDGET) else f"年間見込み（{col}）"
+        data[label] = _cells(result.landing[col].to_numpy(), blank)
+    if method is not None:
+        filled = result.filled[method]
+        for month in result.remaining_months:
+            data[f"{month}_見込み"] = _cells(filled[:, result.months.index(month)], blank)
+    return pd.DataFrame(data)
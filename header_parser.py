@@ -0,0 +1,108 @@
+import copy
+import re
+import unicodedata
+from collections import namedtuple
+
+# 列見出しの解析
+# 「2025年 5月実績金額(発生)」のような見出しを (年度, 月, 計測値) に分解し、ファイルごとに一度だけ索引化する
+FISCAL_START = 4
+FLOW = "実績金額(発生)"
+BUDGET_MEASURE = "予算"
+
+_HEADER_RE = re.compile(r"^(?:(\d{4})\s*年)?\s*(\d{1,2})\s*月\s*(.*)$")
+
+ColumnKey = namedtuple("ColumnKey", ["fiscal_year", "year", "month", "measure"])
+
+
+def fiscal_year_of(year, month, fiscal_start=FISCAL_START):
+    if year is None:
+        return None
+    return year if month >= fiscal_start else year - 1
+
+
+def calendar_year_of(fiscal_year, month, fiscal_start=FISCAL_START):
+    return fiscal_year if month >= fiscal_start else fiscal_year + 1
+
+
+def parse_header(col, fiscal_start=FISCAL_START):
+    # 解析できない見出し（コード・科目名・Unnamed など）は None
+    if not isinstance(col, str):
+        return None
+    text = unicodedata.normalize("NFKC", col).strip()
+    m = _HEADER_RE.match(text)
+    if not m:
+        return None
+    month = int(m.group(2))
+    if not 1 <= month <= 12:
+        return None
+    year = int(m.group(1)) if m.group(1) else None
+    measure = m.group(3).replace(" ", "") or BUDGET_MEASURE
+    return ColumnKey(fiscal_year_of(year, month, fiscal_start), year, month, measure)
+
+
+def month_number(label):
+    key = parse_header(label)
+    return key.month if key else None
+
+
+def month_label(month):
+    return f"{month}月"
+
+
+def budget_months(columns):
+    # 予算ファイルの月列（「4月」など年・計測値のない見出し）を元の順序で返す
+    months = []
+    for col in columns:
+        key = parse_header(col)
+        if key is not None and key.year is None and key.measure == BUDGET_MEASURE:
+            months.append(col)
+    return months
+
+
+class ColumnResolver:
+    # 複数の実績ファイルの見出しを一度だけ解析し、(年度, 月, 計測値) → (ファイルキー, 列名) を辞書で引けるようにする
+    # actual_data: {ファイルキー: DataFrame または列名のリスト}
+    def __init__(self, actual_data, fiscal_start=FISCAL_START, fiscal_year=None):
+        self.table = {}
+        for k, df in actual_data.items():
+            for col in getattr(df, "columns", df):
+                key = parse_header(col, fiscal_start)
+                if key is None or key.fiscal_year is None:
+                    continue
+                # 同じ見出しが複数ファイルにあれば後のファイルを優先
+                self.table[(key.fiscal_year, key.month, key.measure)] = (k, col)
+        years = [fy for (fy, _, measure) in self.table if measure == FLOW]
+        self.fiscal_year = fiscal_year if fiscal_year is not None else (max(years) if years else None)
+
+    def fiscal_years(self, measure=FLOW):
+        # 列のある年度（新しい順）
+        return sorted({fy for (fy, _, m) in self.table if m == measure}, reverse=True)
+
+    def for_year(self, fiscal_year):
+        # 見出しの索引を共有したまま、基準年度だけを変えた resolver
+        other = copy.copy(self)
+        other.fiscal_year = fiscal_year
+        return other
+
+    def _month(self, month):
+        return month if isinstance(month, int) else month_number(month)
+
+    def lookup(self, fiscal_year, month, measure=FLOW):
+        if fiscal_year is None:
+            return None
+        return self.table.get((fiscal_year, self._month(month), measure))
+
+    def current(self, month, measure=FLOW):
+        # 当年度の列（なければ None。前年度の列では代用しない。複数年度を読み込むと前年の実績が当年の実績に見えるため）
+        return self.lookup(self.fiscal_year, month, measure)
+
+    def prior_year(self, month, measure=FLOW):
+        if self.fiscal_year is None:
+            return None
+        return self.lookup(self.fiscal_year - 1, month, measure)
+
+    def current_map(self, months, measure=FLOW):
+        return {m: hit for m in months if (hit := self.current(m, measure)) is not None}
+
+    def prior_year_map(self, months, measure=FLOW):
+        return {m: hit for m in months if (hit := self.prior_year(m, measure)) is not None}
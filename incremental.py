@@ -0,0 +1,272 @@
+import os
+import pickle
+import threading
+import uuid
+from collections import namedtuple
+
+import pandas as pd
+
+import columnar_store
+from aggregation import aggregate_monthly, rollup as period_rollup
+from header_parser import ColumnResolver, budget_months
+from instrumentation import NULL_RECORDER
+from subject_index import LABEL_COL
+from workbook_cache import default_cache
+
+# 差分再計算
+# 入力ファイルごとに「どの月の列を供給しているか」と月ごとの計算結果を保存しておき、
+# 変更のあったファイルに関係する月と、その月を含む期間集計だけを計算し直す
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".yojitsu_cache", "incremental")
+STATE_VERSION = 3  # 3: 当年度の列がない月を前年度の列で代用しない
+
+IncrementalResult = namedtuple(
+    "IncrementalResult",
+    ["monthly", "months", "resolver", "affected_months", "changed_paths", "frames", "timings", "revisions"],
+)
+
+
+class LoadError(Exception):
+    def __init__(self, path, error):
+        super().__init__(f"{path}: {error}")
+        self.path = path
+        self.error = error
+
+
+def input_manifest(budget_path, actual_paths):
+    # 集計結果のキーにする入力ファイルの目録（パスと内容ハッシュ。ハッシュは大きさ・更新日時が変わったときだけ計算し直す）
+    manifest = []
+    for path in [budget_path, *actual_paths]:
+        try:
+            manifest.append((path, default_cache.digest(path)))
+        except OSError as e:
+            raise LoadError(path, e)
+    return tuple(manifest)
+
+
+class IncrementalAggregator:
+    def __init__(self, name, subjects=None, with_prior_year=True, state_dir=STATE_DIR, executor="thread"):
+        self.state_path = os.path.join(state_dir, f"{name}.pkl")
+        self.subjects = list(subjects) if subjects is not None else None
+        self.with_prior_year = with_prior_year
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._state_mtime = None
+        self.state = self._load_state()
+
+    # --- 状態の保存・復元 ---
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.state_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_state(self):
+        self._state_mtime = self._stat_mtime()
+        try:
+            with open(self.state_path, "rb") as f:
+                state = pickle.load(f)
+        except Exception:
+            return None
+        return state if state.get("version") == STATE_VERSION else None
+
+    def _reload_if_changed(self):
+        # 別のプロセス（監視プロセスなど）が保存した状態があれば読み直す
+        if self._stat_mtime() != self._state_mtime:
+            state = self._load_state()
+            if state is not None:
+                self.state = state
+
+    def _save_state(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.state_path)
+            self._state_mtime = self._stat_mtime()
+        except OSError:
+            # 保存できなくても今回の結果はそのまま使える
+            pass
+
+    def reset(self):
+        with self._lock:
+            self.state = None
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+
+    # --- 月次の差分計算 ---
+    def run(self, budget_path, actual_paths, recorder=NULL_RECORDER):
+        with self._lock:
+            self._reload_if_changed()
+            return self._run(budget_path, list(actual_paths), recorder)
+
+    def _run(self, budget_path, actual_paths, recorder):
+        frames = {}
+        timings = []
+
+        def check(got_timings):
+            timings.extend(got_timings)
+            for t in got_timings:
+                if t.error is not None:
+                    raise LoadError(t.path, t.error)
+
+        def read_headers(paths):
+            # 見出しだけを先に読み、必要な列を決めてから本体を読む
+            if not paths:
+                return {}
+            with recorder.stage("見出し読込", rows=len(paths)):
+                got, got_timings = columnar_store.headers_many(paths, executor=self.executor)
+            check(got_timings)
+            return got
+
+        def load(columns):
+            # columns: {パス: 列名リスト}。読込済みの列は読み直さない
+            need = {
+                p: list(dict.fromkeys(cols)) for p, cols in columns.items()
+                if p not in frames or not set(cols) <= set(frames[p].columns)
+            }
+            if not need:
+                return
+            with recorder.stage("読込") as s:
+                got, got_timings = columnar_store.load_many(list(need), columns=need, executor=self.executor)
+                s.rows = sum(t.rows for t in got_timings)
+            check(got_timings)
+            frames.update(got)
+
+        try:
+            digests = {p: default_cache.digest(p) for p in [budget_path, *actual_paths]}
+        except OSError as e:
+            raise LoadError(getattr(e, "filename", None) or budget_path, e)
+
+        state = self.state
+        full = (
+            state is None
+            or state["budget"] != (budget_path, digests[budget_path])
+            or state["subjects"] != self.subjects
+            or state["with_prior_year"] != self.with_prior_year
+        )
+        if full:
+            headers = read_headers([budget_path, *actual_paths])
+            months = budget_months(headers[budget_path])
+            changed = list(actual_paths)
+            removed = []
+            state = {
+                "version": STATE_VERSION,
+                # 作り直すたびに変わるID。月の版（generation:月:再計算回数）を画面側のキャッシュキーに使う
+                "generation": uuid.uuid4().hex,
+                "budget": (budget_path, digests[budget_path]),
+                "subjects": self.subjects,
+                "with_prior_year": self.with_prior_year,
+                "months": months,
+                "digests": {},
+                "headers": {},
+                "actual_cols": {},
+                "prev_cols": {},
+                "blocks": {},
+                "month_rev": {},
+                "rollups": {},
+            }
+        else:
+            months = state["months"]
+            changed = [p for p in actual_paths if state["digests"].get(p) != digests[p]]
+            removed = [p for p in state["digests"] if p not in digests]
+            # 変更のあったファイルだけ見出しを読み、それ以外は保存済みの見出しを使う
+            headers = {**state["headers"], **read_headers(changed)}
+
+        with recorder.stage("列対応", rows=len(actual_paths)):
+            resolver = ColumnResolver({p: headers[p] for p in actual_paths})
+            actual_cols = resolver.current_map(months)
+            prev_cols = resolver.prior_year_map(months) if self.with_prior_year else {}
+
+        touched = set(changed) | set(removed)
+
+        def source(cols, m):
+            hit = cols.get(m)
+            return hit[0] if hit else None
+
+        affected = [
+            m for m in months
+            if full
+            or actual_cols.get(m) != state["actual_cols"].get(m)
+            or prev_cols.get(m) != state["prev_cols"].get(m)
+            or source(actual_cols, m) in touched
+            or source(prev_cols, m) in touched
+            or m not in state["blocks"]
+        ]
+
+        if affected:
+            # 対象月の予算列と、対象月の実績・前年実績の列だけを読む
+            columns = {budget_path: list(months)}
+            for cols in (actual_cols, prev_cols):
+                for m in affected:
+                    if m in cols:
+                        columns.setdefault(cols[m][0], []).append(cols[m][1])
+            load(columns)
+            with recorder.stage("月次集計") as s:
+                part = aggregate_monthly(
+                    frames[budget_path], LABEL_COL, affected, frames,
+                    {m: actual_cols[m] for m in affected if m in actual_cols},
+                    {m: prev_cols[m] for m in affected if m in prev_cols},
+                    subjects=self.subjects,
+                )
+                s.rows = len(part) * len(affected)
+            for m in affected:
+                state["blocks"][m] = part[m]
+                state["month_rev"][m] = state["month_rev"].get(m, 0) + 1
+
+        state["digests"] = {p: digests[p] for p in actual_paths}
+        state["headers"] = {p: headers[p] for p in actual_paths}
+        state["actual_cols"] = actual_cols
+        state["prev_cols"] = prev_cols
+        self.state = state
+        self._save_state()
+
+        monthly = self._assemble(state["blocks"], months, "月")
+        revisions = {m: f"{state['generation']}:{m}:{state['month_rev'][m]}" for m in months}
+        return IncrementalResult(monthly, months, resolver, affected, changed + removed, frames, timings, revisions)
+
+    # --- 期間集計の差分計算 ---
+    def rollup(self, name, groups, recorder=NULL_RECORDER):
+        # 前回計算時から月の計算結果が変わった期間だけ集計し直す
+        with self._lock, recorder.stage(f"{name}集計") as s:
+            self._reload_if_changed()
+            state = self.state
+            if state is None:
+                raise RuntimeError("run() を先に呼んでください")
+            monthly = self._assemble(state["blocks"], state["months"], "月")
+            saved = state["rollups"].get(name)
+            if saved is None or saved["groups"] != groups:
+                saved = {"groups": groups, "blocks": {}, "revs": {}}
+            stale = {}
+            for period, period_months in groups.items():
+                revs = {m: state["month_rev"].get(m, 0) for m in period_months}
+                if period not in saved["blocks"] or saved["revs"].get(period) != revs:
+                    stale[period] = period_months
+                    saved["revs"][period] = revs
+            if stale:
+                part = period_rollup(monthly, stale)
+                s.rows = len(part) * len(stale)
+                for period in stale:
+                    saved["blocks"][period] = part[period]
+            state["rollups"][name] = saved
+            if stale:
+                self._save_state()
+            return self._assemble(saved["blocks"], list(groups), "期間")
+
+    # --- 出力済みの版の記録 ---
+    def is_written(self, output, revisions):
+        # output（出力ファイル名など）を revisions（IncrementalResult.revisions）の版で書き出し済みか
+        with self._lock:
+            return self.state is not None and self.state.get("outputs", {}).get(output) == revisions
+
+    def mark_written(self, output, revisions):
+        with self._lock:
+            if self.state is not None:
+                self.state.setdefault("outputs", {})[output] = dict(revisions)
+                self._save_state()
+
+    @staticmethod
+    def _assemble(blocks, keys, level_name):
+        frame = pd.concat([blocks[k] for k in keys], axis=1, keys=keys)
+        frame.columns = frame.columns.set_names([level_name, "計測値"])
+        return frame
@@ -0,0 +1,135 @@
+import importlib.util
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from workbook_cache import default_cache
+
+# 実績・予算ファイルの一括読込
+# キャッシュにないファイルだけをプールで並列に読み、ファイルごとの所要時間を記録する
+# 読込エンジン: calamine（Rust製、python-calamine があれば）→ openpyxl（pandas 標準。読取専用・値のみで開く）
+READER_BACKEND = os.environ.get("YOJITSU_READER", "auto")
+READER_BACKENDS = ("calamine", "openpyxl")
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+
+FileTiming = namedtuple("FileTiming", ["path", "backend", "seconds", "rows", "cached", "error"])
+
+
+def available_backends():
+    backends = []
+    if importlib.util.find_spec("python_calamine") is not None:
+        backends.append("calamine")
+    backends.append("openpyxl")
+    return backends
+
+
+def backend_order(backend="auto"):
+    # 指定エンジンを先頭に、使える残りのエンジンを予備として並べる
+    available = available_backends()
+    if backend in (None, "", "auto"):
+        return available
+    if backend not in READER_BACKENDS:
+        raise ValueError(f"未対応の読込エンジンです: {backend}（{', '.join(READER_BACKENDS)}）")
+    return [backend] + [b for b in available if b != backend]
+
+
+def read_workbook(path, backend="auto", **read_kwargs):
+    # 戻り値: (DataFrame, 実際に使ったエンジン)。エンジンが失敗したら次のエンジンで読み直す
+    last_error = None
+    for name in backend_order(backend):
+        try:
+            return pd.read_excel(path, engine=name, **read_kwargs), name
+        except Exception as e:
+            last_error = e
+    raise last_error
+
+
+def _read_timed(path, backend, read_kwargs):
+    # プールのワーカーで実行される（プロセスプールでも呼べるようモジュール直下に置く）
+    start = time.perf_counter()
+    df, used = read_workbook(path, backend, **read_kwargs)
+    return df, used, time.perf_counter() - start
+
+
+def _make_executor(executor, workers):
+    if executor == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def read_many(paths, backend=READER_BACKEND, executor="process", max_workers=MAX_WORKERS, cache=default_cache, **read_kwargs):
+    # 戻り値: ({パス: DataFrame}, [FileTiming, ...])。読込に失敗したファイルは FileTiming.error に例外を入れる
+    frames = {}
+    timings = {}
+    misses = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            df = cache.get(path, **read_kwargs) if cache is not None else None
+        except OSError as e:
+            timings[path] = FileTiming(path, None, time.perf_counter() - start, 0, False, e)
+            continue
+        if df is None:
+            misses.append(path)
+        else:
+            frames[path] = df
+            timings[path] = FileTiming(path, "cache", time.perf_counter() - start, len(df), True, None)
+
+    if misses:
+        workers = max(1, min(max_workers or 1, len(misses)))
+        # 1件だけならプールを作らずその場で読む
+        mode = executor if workers > 1 else "inline"
+        try:
+            results = _run(misses, backend, read_kwargs, mode, workers)
+        except (BrokenProcessPool, OSError, PermissionError):
+            # プロセスを起動できない環境ではスレッドで読み直す
+            results = _run(misses, backend, read_kwargs, "thread", workers)
+        for path, outcome in results.items():
+            if isinstance(outcome, BaseException):
+                timings[path] = FileTiming(path, None, 0.0, 0, False, outcome)
+                continue
+            df, used, seconds = outcome
+            if cache is not None:
+                cache.put(path, df, **read_kwargs)
+                df = df.copy()
+            frames[path] = df
+            timings[path] = FileTiming(path, used, seconds, len(df), False, None)
+
+    return frames, [timings[p] for p in paths if p in timings]
+
+
+def _run(paths, backend, read_kwargs, mode, workers):
+    results = {}
+    if mode == "inline":
+        for path in paths:
+            try:
+                results[path] = _read_timed(path, backend, read_kwargs)
+            except Exception as e:
+                results[path] = e
+        return results
+    with _make_executor(mode, workers) as pool:
+        futures = {path: pool.submit(_read_timed, path, backend, read_kwargs) for path in paths}
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                results[path] = e
+    return results
+
+
+def format_timings(timings):
+    # 遅い順に「ファイル名: 秒数（エンジン, 行数）」
+    lines = []
+    for t in sorted(timings, key=lambda t: t.seconds, reverse=True):
+        name = os.path.basename(t.path)
+        if t.error is not None:
+            lines.append(f"{name}: 読込失敗 ({t.error})")
+        else:
+            lines.append(f"{name}: {t.seconds:.3f}秒（{t.backend}, {t.rows}行）")
+    return lines
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+# 処理段階ごとの計測
+# 段階ごとに経過時間・処理行数・ピークメモリ（tracemalloc。段階開始時点からの増分）を記録し、実行の終わりに1段階1行の JSON で追記する
+# 出力先は環境変数 YOJITSU_TIMING_LOG で変更できる（空文字なら書き出さない）
+# tracemalloc は処理が数倍遅くなるので、メモリ計測は YOJITSU_TRACE_MEMORY=1 か trace_memory=True のときだけ行う
+# tracemalloc はプロセスに1つしかないので、同時に測るのは1つの Recorder だけ（最も外側の段階の間。
+# 画面の複数セッションなど、他の Recorder が測っている間に始まった段階のピークメモリは記録しない。
+# 測った段階のピークには同じプロセスの他のスレッドが確保した分も含まれる）
+LOG_PATH = os.environ.get(
+    "YOJITSU_TIMING_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "timings.jsonl")
+)
+TRACE_MEMORY = os.environ.get("YOJITSU_TRACE_MEMORY", "0") == "1"
+
+StageRecord = namedtuple("StageRecord", ["stage", "seconds", "rows", "peak_mb", "depth", "started_at"])
+
+_log_lock = threading.Lock()
+_trace_lock = threading.Lock()
+_trace_owner = None  # メモリを測っている Recorder
+
+
+class _Stage:
+    def __init__(self, rows=None):
+        self.rows = rows
+        self.base = 0
+        self.peak = 0
+
+
+class Recorder:
+    def __init__(self, entry, log_path=LOG_PATH, trace_memory=TRACE_MEMORY, enabled=True):
+        self.entry = entry
+        self.log_path = log_path
+        self.trace_memory = trace_memory
+        self.enabled = enabled
+        self.run_id = uuid.uuid4().hex[:12]
+        self.records = []
+        self._stack = []
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        # with recorder.stage("月次集計") as s: ...; s.rows = len(df)
+        current = _Stage(rows)
+        if not self.enabled:
+            yield current
+            return
+        tracing = self.trace_memory and self._acquire_tracing()
+        if tracing and self._stack:
+            # 外側の段階のそれまでのピークを退避してから計測し直す
+            self._stack[-1].peak = max(self._stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        if tracing:
+            tracemalloc.reset_peak()
+            current.base = tracemalloc.get_traced_memory()[0]
+        self._stack.append(current)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            peak_mb = None
+            if tracing:
+                current.peak = max(current.peak, tracemalloc.get_traced_memory()[1])
+                # 段階開始時点からの増分をその段階のピークとする
+                peak_mb = round(max(0, current.peak - current.base) / 1024 ** 2, 2)
+                if self._stack:
+                    self._stack[-1].peak = max(self._stack[-1].peak, current.peak)
+                    tracemalloc.reset_peak()
+            self.records.append(StageRecord(name, seconds, current.rows, peak_mb, len(self._stack), started_at))
+            if not self._stack:
+                self._release_tracing()
+
+    def _acquire_tracing(self):
+        # 戻り値: この Recorder がメモリを測れるか（他の Recorder が測っていなければ測る側になる）
+        global _trace_owner
+        with _trace_lock:
+            if _trace_owner is None:
+                _trace_owner = self
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+            return _trace_owner is self
+
+    def _release_tracing(self):
+        global _trace_owner
+        with _trace_lock:
+            if _trace_owner is not self:
+                return
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+            _trace_owner = None
+
+    def record(self, name, seconds, rows=None):
+        # 外で測った時間を1段階として残す（スクリプトの開始から画面を出すまでなど、with で囲めない区間）
+        if self.enabled:
+            self.records.append(StageRecord(name, seconds, rows, None, len(self._stack), time.time() - seconds))
+
+    def frame_rows(self):
+        # 診断表示用（内側の段階は字下げする）
+        return [
+            {
+                "段階": "　" * r.depth + r.stage,
+                "秒": round(r.seconds, 4),
+                "行数": r.rows,
+                "ピークメモリ(MB)": r.peak_mb,
+            }
+            for r in sorted(self.records, key=lambda r: r.started_at)
+        ]
+
+    def format_lines(self):
+        lines = []
+        for r in sorted(self.records, key=lambda r: r.started_at):
+            extra = []
+            if r.rows is not None:
+                extra.append(f"{r.rows}行")
+            if r.peak_mb is not None:
+                extra.append(f"ピーク{r.peak_mb}MB")
+            suffix = f"（{', '.join(extra)}）" if extra else ""
+            lines.append(f"{'  ' * r.depth}{r.stage}: {r.seconds:.3f}秒{suffix}")
+        return lines
+
+    def flush(self):
+        # 記録を JSON Lines で追記して空にする（書けなくても処理は止めない）
+        records, self.records = self.records, []
+        if not self.enabled or not self.log_path or not records:
+            return records
+        lines = [
+            json.dumps({
+                "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(r.started_at)),
+                "entry": self.entry,
+                "run_id": self.run_id,
+                "stage": r.stage,
+                "depth": r.depth,
+                "seconds": round(r.seconds, 6),
+                "rows": r.rows,
+                "peak_mb": r.peak_mb,
+            }, ensure_ascii=False)
+            for r in records
+        ]
+        try:
+            with _log_lock, open(self.log_path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError:
+            pass
+        return records
+
+
+NULL_RECORDER = Recorder("null", enabled=False)
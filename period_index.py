@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from aggregation import ACTUAL, ACTUAL_MONTHS, ACTUAL_TOTAL, BUDGET, BUDGET_TOTAL, DIFF, PREV_ACTUAL, PREV_TOTAL, RATE, YOY
+
+# 期間累計の索引
+# 月次の予算・実績・前年実績を科目ごとに累積和で持ち、年度累計・四半期・移動3/6/12か月・任意期間を
+# 科目あたり O(1)（累積和の差）で求める
+RANGE_MEASURES = [BUDGET_TOTAL, ACTUAL_TOTAL, PREV_TOTAL, DIFF, RATE, YOY, ACTUAL_MONTHS]
+
+YTD_COLUMNS = [(BUDGET_TOTAL, "累計予算"), (ACTUAL_TOTAL, "累計実績"), (DIFF, "累計差額"), (RATE, "累計達成率")]
+RANGE_COLUMNS = [(BUDGET_TOTAL, "予算"), (ACTUAL_TOTAL, "実績"), (DIFF, "差額"), (RATE, "対予算比%"),
+                 (PREV_TOTAL, "前年実績"), (YOY, "前年比%")]
+
+
+def _prefix(values):
+    # 先頭に0列を足した累積和（欠損は0扱い）。区間 [i, j] の合計は cum[:, j+1] - cum[:, i]
+    cum = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(np.nan_to_num(values), axis=1, out=cum[:, 1:])
+    return cum
+
+
+class PeriodIndex:
+    def __init__(self, monthly):
+        # monthly: aggregate_monthly の戻り値（columns=(月, 計測値)）
+        self.months = list(dict.fromkeys(monthly.columns.get_level_values(0)))
+        self.subjects = monthly.index
+        self._pos = {m: i for i, m in enumerate(self.months)}
+        actual = monthly.xs(ACTUAL, axis=1, level=1)[self.months].to_numpy(dtype=float)
+        self._cum = {
+            BUDGET: _prefix(monthly.xs(BUDGET, axis=1, level=1)[self.months].to_numpy(dtype=float)),
+            ACTUAL: _prefix(actual),
+            PREV_ACTUAL: _prefix(monthly.xs(PREV_ACTUAL, axis=1, level=1)[self.months].to_numpy(dtype=float)),
+        }
+        self._count = _prefix((~np.isnan(actual)).astype(float))
+
+    def position(self, month):
+        if isinstance(month, (int, np.integer)):
+            return int(month)
+        if month not in self._pos:
+            raise KeyError(f"月が見つかりません: {month}（{', '.join(self.months)}）")
+        return self._pos[month]
+
+    def last_actual_month(self):
+        # 実績が1科目でも入っている最後の月（なければ None）
+        filled = np.flatnonzero(np.diff(self._count.sum(axis=0)) > 0)
+        return self.months[filled[-1]] if len(filled) else None
+
+    def sums(self, start, end):
+        # 区間 [start, end]（両端含む）の合計を {計測値: 科目ごとの配列} で返す
+        i, j = self.position(start), self.position(end)
+        if i > j:
+            raise ValueError(f"期間の開始が終了より後です: {start}〜{end}")
+        sums = {measure: cum[:, j + 1] - cum[:, i] for measure, cum in self._cum.items()}
+        sums[ACTUAL_MONTHS] = self._count[:, j + 1] - self._count[:, i]
+        return sums
+
+    def range(self, start, end):
+        # 期間集計と同じ規則（合計0は空欄、率は小数1桁）で1期間分の表を返す
+        return self._frame(self.sums(start, end))
+
+    def rolling_start(self, window, end):
+        # 直近 window か月の最初の月（年度の先頭より前にははみ出さない）
+        return self.months[max(0, self.position(end) - window + 1)]
+
+    def ranges(self, periods):
+        # {ラベル: (開始月, 終了月)} をまとめて計算し、columns=(期間, 計測値) の表にする
+        blocks = {label: self.range(start, end) for label, (start, end) in periods.items()}
+        frame = pd.concat(list(blocks.values()), axis=1, keys=list(blocks))
+        frame.columns = frame.columns.set_names(["期間", "計測値"])
+        return frame
+
+    def ytd_table(self):
+        # 各月時点の年度累計
+        return self.ranges({m: (self.months[0], m) for m in self.months})
+
+    def _frame(self, sums):
+        budget, actual, prev = sums[BUDGET], sums[ACTUAL], sums[PREV_ACTUAL]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            has_budget = budget != 0
+            has_prev = prev != 0
+            data = {
+                BUDGET_TOTAL: np.where(has_budget, budget, np.nan),
+                ACTUAL_TOTAL: np.where(actual != 0, actual, np.nan),
+                PREV_TOTAL: np.where(has_prev, prev, np.nan),
+                DIFF: np.where(has_budget, actual - budget, np.nan),
+                RATE: np.where(has_budget, np.round(actual / budget * 100, 1), np.nan),
+                YOY: np.where(has_prev & (actual != 0), np.round(actual / prev * 100, 1), np.nan),
+                ACTUAL_MONTHS: sums[ACTUAL_MONTHS],
+            }
+        frame = pd.DataFrame(data, index=self.subjects)[RANGE_MEASURES]
+        frame.columns.name = "計測値"
+        return frame
@@ -0,0 +1,175 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import columnar_store
+from aggregation import ACTUAL, AMOUNT_MEASURES, APP_COLUMNS, BUDGET, DIFF, RATE, YOY, aggregate_monthly
+from subject_index import LABEL_COL
+from workbook_cache import default_cache
+
+# 月別プレビュー
+# 選択された月の指標・原価率/販管費率だけを計算し、月の版（再計算の回数や元ファイルの内容）をキーに保持する
+# 月を切り替えても計算済みの月は作り直さない
+COST_RATIO = "原価率(%)"
+SGA_RATIO = "販管費率(%)"
+SUMMARY_AFTER = "経常利益"  # 原価率・販管費率の行はこの科目の直後に置く
+CARD_FIELDS = [(ACTUAL, "実績"), (BUDGET, "予算"), (DIFF, "差額"), (RATE, "対予算比"), (YOY, "前年比")]
+MAX_CACHED = 256
+
+
+class _Pending:
+    # 計算中の値（同じキーの要求は計算が終わるまで待って同じ結果を受け取る）
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Memo:
+    # 版をキーにした小さな LRU（月ごとの表示用データ・カードのHTML・集計結果）
+    # 同じキーの計算が同時に要求されたときは1回だけ計算し、他は結果を待つ（失敗は保持しない）
+    def __init__(self, max_entries=MAX_CACHED):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _Pending()
+        if not owner:
+            return pending.wait()
+        try:
+            pending.value = compute()
+        except BaseException as e:
+            pending.error = e
+            raise
+        else:
+            with self._lock:
+                self._items[key] = pending.value
+                while len(self._items) > self.max_entries:
+                    self._items.popitem(last=False)
+            return pending.value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.event.set()
+
+    def discard(self, predicate):
+        # predicate(キー) が真の項目を捨てる（入力が変わったときの無効化）
+        with self._lock:
+            for key in [k for k in self._items if predicate(k)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+default_memo = Memo()
+
+
+def _cell(value, integer):
+    if pd.isna(value):
+        return ""
+    return int(value) if integer else float(value)
+
+
+def _ratio(num, denom):
+    if denom in ("", 0, None) or num in ("", None):
+        return ""
+    return f"{round(float(num) / float(denom) * 100, 1)}%"
+
+
+def summary_ratios(values):
+    # values: {科目名: {計測値: 値}}。原価率 = (売上高 - 売上総利益) / 売上高、販管費率 = 販管費 / 売上高
+    def actual(subject):
+        value = values.get(subject, {}).get(ACTUAL, "")
+        return 0 if value in ("", None) else value
+
+    try:
+        sales = actual("売上高")
+        cost = sales - actual("売上総利益")
+        return {COST_RATIO: _ratio(cost, sales), SGA_RATIO: _ratio(actual("販売費及び一般管理費"), sales)}
+    except (TypeError, ValueError):
+        return {COST_RATIO: "", SGA_RATIO: ""}
+
+
+def month_view(block):
+    # block: 1か月分の計測値（index=科目名、columns=計測値、千円）
+    # 戻り値: {科目名: {計測値: 値}}。欠損は ""。原価率・販管費率の行は実績欄に「12.3%」の形で入れる
+    columns = {
+        measure: [_cell(v, measure in AMOUNT_MEASURES) for v in block[measure]]
+        for measure, _ in APP_COLUMNS
+    }
+    values = {
+        subject: {measure: columns[measure][i] for measure, _ in APP_COLUMNS}
+        for i, subject in enumerate(block.index)
+    }
+    ratios = summary_ratios(values)
+    view = {}
+    for subject, row in values.items():
+        view[subject] = row
+        if subject == SUMMARY_AFTER:
+            view.update({name: {ACTUAL: ratio} for name, ratio in ratios.items()})
+    for name, ratio in ratios.items():
+        view.setdefault(name, {ACTUAL: ratio})
+    return view
+
+
+def cached_view(token, block_fn, memo=default_memo):
+    # token: 月の版。block_fn はキャッシュにないときだけ呼ばれる
+    return memo.get(("view", token), lambda: month_view(block_fn()))
+
+
+def other_year_block(resolver, month, subjects):
+    # 予算のない年度（前年度など）の1か月分。戻り値: (月の版, 計測値を返す関数)
+    # 実績・前年実績の列だけを読み、予算・差額・対予算比は空欄になる
+    hits = {"actual": resolver.lookup(resolver.fiscal_year, month), "prev": resolver.prior_year(month)}
+    hits = {k: hit for k, hit in hits.items() if hit is not None}
+    token = ("year", resolver.fiscal_year, month, tuple(subjects),
+             tuple((k, hit, default_cache.digest(hit[0])) for k, hit in sorted(hits.items())))
+
+    def compute():
+        columns = {}
+        for path, col in hits.values():
+            columns.setdefault(path, []).append(col)
+        frames, _ = columnar_store.load_many(list(columns), columns=columns)
+        no_budget = pd.DataFrame({LABEL_COL: list(subjects), month: float("nan")})
+        part = aggregate_monthly(
+            no_budget, LABEL_COL, [month], frames,
+            {month: hits["actual"]} if "actual" in hits else {},
+            {month: hits["prev"]} if "prev" in hits else {},
+            subjects=subjects,
+        )
+        return part[month]
+
+    return token, compute
+
+
+def card_row(view, subject):
+    row = view.get(subject, {})
+    return {label: row.get(measure, "") for measure, label in CARD_FIELDS}
+
+
+def table(views):
+    # views: {月: month_view の戻り値}（表示順）。「{月}_{ラベル}」形式の表（ダウンロード用）
+    subjects = list(dict.fromkeys(s for view in views.values() for s in view))
+    data = {"科目名": subjects}
+    for month, view in views.items():
+        for measure, label in APP_COLUMNS:
+            data[f"{month}_{label}"] = [view.get(s, {}).get(measure, "") for s in subjects]
+    return pd.DataFrame(data)
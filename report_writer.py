@@ -0,0 +1,133 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# 集計結果のExcel出力
+# 全シートを1つのブックに、行を順に流し込む書込モードで1回で書き出す（書式も同時に設定）
+# xlsxwriter があれば constant_memory モード、なければ openpyxl の write_only モードを使う
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+AMOUNT_FORMAT = "#,##0"
+RATE_FORMAT = "0.0"
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MAX_CACHED_REPORTS = 8
+
+
+def column_format(label):
+    # 率・比の列は小数1桁、それ以外の数値列は桁区切り
+    label = str(label)
+    if label == "科目名":
+        return None
+    if label.endswith("%") or "率" in label or label.endswith("比"):
+        return RATE_FORMAT
+    return AMOUNT_FORMAT
+
+
+def _cell_value(value):
+    if value is None or value is pd.NA or (isinstance(value, str) and value == ""):
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _write_xlsxwriter(target, sheets):
+    workbook = xlsxwriter.Workbook(target, {"constant_memory": True, "nan_inf_to_errors": True})
+    header = workbook.add_format({"bold": True})
+    formats = {fmt: workbook.add_format({"num_format": fmt}) for fmt in (AMOUNT_FORMAT, RATE_FORMAT)}
+    for name, df in sheets.items():
+        ws = workbook.add_worksheet(name[:31])
+        col_formats = [formats.get(column_format(c)) for c in df.columns]
+        for c, label in enumerate(df.columns):
+            ws.write(0, c, str(label), header)
+        for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            for c, value in enumerate(row):
+                value = _cell_value(value)
+                if value is not None:
+                    ws.write(r, c, value, col_formats[c])
+    workbook.close()
+
+
+def _write_openpyxl(target, sheets):
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    workbook = Workbook(write_only=True)
+    bold = Font(bold=True)
+    for name, df in sheets.items():
+        ws = workbook.create_sheet(name[:31])
+        header = []
+        for label in df.columns:
+            cell = WriteOnlyCell(ws, value=str(label))
+            cell.font = bold
+            header.append(cell)
+        ws.append(header)
+        col_formats = [column_format(c) for c in df.columns]
+        for row in df.itertuples(index=False, name=None):
+            cells = []
+            for value, fmt in zip(row, col_formats):
+                value = _cell_value(value)
+                if value is None or fmt is None:
+                    cells.append(value)
+                    continue
+                cell = WriteOnlyCell(ws, value=value)
+                cell.number_format = fmt
+                cells.append(cell)
+            ws.append(cells)
+    workbook.save(target)
+
+
+def write_report(target, sheets):
+    # target: 保存先パスまたはファイルオブジェクト、sheets: {シート名: 表}（シート順に書き出す）
+    if xlsxwriter is not None:
+        _write_xlsxwriter(target, sheets)
+    else:
+        _write_openpyxl(target, sheets)
+
+
+def report_bytes(sheets):
+    output = io.BytesIO()
+    write_report(output, sheets)
+    return output.getvalue()
+
+
+def sheets_digest(sheets):
+    h = hashlib.sha256()
+    for name, df in sheets.items():
+        h.update(str(name).encode("utf-8"))
+        h.update(repr(list(df.columns)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+_reports = OrderedDict()
+_reports_lock = threading.Lock()
+
+
+def cached_report(sheets, digest=None):
+    # 同じ内容のレポートは作り直さない（結果のハッシュで最近のものをいくつか保持）
+    digest = digest or sheets_digest(sheets)
+    with _reports_lock:
+        data = _reports.get(digest)
+        if data is not None:
+            _reports.move_to_end(digest)
+            return data
+    data = report_bytes(sheets)
+    with _reports_lock:
+        _reports[digest] = data
+        while len(_reports) > MAX_CACHED_REPORTS:
+            _reports.popitem(last=False)
+    return data
+
+
+def lazy_report(sheets):
+    # ダウンロードボタンに渡す関数（押されたときだけブックを作る）
+    digest = sheets_digest(sheets)
+    return lambda: cached_report(sheets, digest)
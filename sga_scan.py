@@ -0,0 +1,112 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from preview import Memo
+from subject_index import normalize_subject
+
+# 販売費及び一般管理費の明細チェック
+# 役員報酬〜雑費の各明細について、全月の前年比・前月比・予算差をファクト表から引いた科目×月の行列で一度に計算し、
+# しきい値（±%・金額差・上位件数）を超えたものを影響額の大きい順に並べる
+SGA_FIRST = "役員報酬"
+SGA_LAST = "雑費"
+
+ScanThresholds = namedtuple("ScanThresholds", ["pct", "min_abs", "top_n"], defaults=[10.0, 0, 50])
+
+METRIC_COLUMNS = ["月", "科目名", "実績", "前年実績", "前年比%", "前月実績", "前月比%", "予算", "予算差額", "対予算比%"]
+RESULT_COLUMNS = METRIC_COLUMNS + ["該当", "影響額"]
+AMOUNT_COLUMNS = ["実績", "前年実績", "前月実績", "予算", "予算差額", "影響額"]
+
+default_memo = Memo(max_entries=16)
+
+
+def line_range(subjects, first=SGA_FIRST, last=SGA_LAST):
+    # 明細の並び（科目キーを索引に持つ表・系列）のうち first〜last の範囲。見つからなければ空
+    keys = subjects.index
+    try:
+        i, j = keys.get_loc(normalize_subject(first)), keys.get_loc(normalize_subject(last))
+    except KeyError:
+        return keys[:0]
+    return keys[i:j + 1] if isinstance(i, int) and isinstance(j, int) and i <= j else keys[:0]
+
+
+def _matrix(frame, keys, months):
+    return frame.reindex(index=keys, columns=months).to_numpy(dtype=float, na_value=np.nan)
+
+
+def _ratio(num, denom):
+    # 0・欠損を含む比は空欄（従来の明細ピックアップと同じ扱い）
+    with np.errstate(divide="ignore", invalid="ignore"):
+        valid = (denom != 0) & (num != 0) & ~np.isnan(num) & ~np.isnan(denom)
+        return np.where(valid, np.round(num / denom * 100, 1), np.nan)
+
+
+def line_metrics(labels, months, actual, prior, prev_month, budget):
+    # 明細×月の行列（円）から縦持ちの表（METRIC_COLUMNS）を作る
+    n_lines, n_months = actual.shape
+    data = {
+        "月": np.tile(np.asarray(months, dtype=object), n_lines),
+        "科目名": np.repeat(labels, n_months),
+        "実績": actual.ravel(),
+        "前年実績": prior.ravel(),
+        "前年比%": _ratio(actual, prior).ravel(),
+        "前月実績": prev_month.ravel(),
+        "前月比%": _ratio(actual, prev_month).ravel(),
+        "予算": budget.ravel(),
+        "予算差額": (actual - budget).ravel(),
+        "対予算比%": _ratio(actual, budget).ravel(),
+    }
+    metrics = pd.DataFrame(data, columns=METRIC_COLUMNS)
+    # 実績のない月は対象外
+    return metrics[~np.isnan(metrics["実績"].to_numpy())].reset_index(drop=True)
+
+
+def metrics_source(store, entity, fiscal_year, months):
+    # 戻り値: (版, 明細×月の表を作る関数)。値はファクト表から予算・実績・前年同月・前月をまとめて引く
+    # 版はファクト表の同期番号（ファイルが変わると増える）
+    token = ("facts", store.path, entity, fiscal_year, tuple(months), store.revision(entity))
+
+    def compute():
+        subjects = store.subjects(entity)
+        keys = line_range(subjects)
+        if fiscal_year is None or keys.empty:
+            return pd.DataFrame(columns=METRIC_COLUMNS)
+        values = store.comparison(entity, fiscal_year, months)
+        labels = subjects.loc[keys].to_numpy()
+        matrices = [_matrix(values[k], keys, months) for k in ("actual", "prior_year", "prior_month", "budget")]
+        return line_metrics(labels, months, *matrices)
+
+    return token, compute
+
+
+def exceptions(metrics, thresholds=ScanThresholds()):
+    # しきい値を超えた明細を影響額（該当した比較の金額差の最大）の大きい順に top_n 件
+    pct, min_abs, top_n = thresholds
+    if metrics.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    actual = metrics["実績"].to_numpy()
+    checks = [
+        ("前年比", metrics["前年比%"].to_numpy(), actual - metrics["前年実績"].to_numpy()),
+        ("前月比", metrics["前月比%"].to_numpy(), actual - metrics["前月実績"].to_numpy()),
+        ("予算比", metrics["対予算比%"].to_numpy(), metrics["予算差額"].to_numpy()),
+    ]
+    impact = np.zeros(len(metrics))
+    hit_any = np.zeros(len(metrics), dtype=bool)
+    labels = np.full(len(metrics), "", dtype=object)
+    for name, ratio, diff in checks:
+        with np.errstate(invalid="ignore"):
+            hit = (np.abs(ratio - 100) >= pct) & (np.abs(diff) >= min_abs)
+        hit = np.nan_to_num(hit, nan=False).astype(bool)
+        arrow = np.where(ratio >= 100, "↑", "↓")
+        tag = np.char.add(np.char.add(name, arrow), np.char.mod("%.1f%%", np.nan_to_num(ratio)))
+        labels = np.where(hit, np.where(labels == "", tag, labels + "・" + tag), labels)
+        impact = np.where(hit, np.maximum(impact, np.abs(np.nan_to_num(diff))), impact)
+        hit_any |= hit
+    result = metrics[hit_any].copy()
+    result["該当"] = labels[hit_any]
+    result["影響額"] = impact[hit_any]
+    result = result.sort_values("影響額", ascending=False, kind="stable").head(int(top_n))
+    for col in AMOUNT_COLUMNS:
+        result[col] = result[col].round().astype("Int64")
+    return result.reset_index(drop=True)[RESULT_COLUMNS]
@@ -0,0 +1,109 @@
+import csv
+import os
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# 科目名の正規化と索引
+# 読込時に一度だけ科目列を正規化キーに変換し、以後の照合はハッシュ表で行う
+ALIAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "科目別名.csv")
+KEY_NAME = "科目キー"
+LABEL_COL = "科目名"
+
+
+def _normalize_raw(name):
+    s = unicodedata.normalize("NFKC", str(name)).strip()
+    return s.replace(" ", "").replace("　", "").replace("および", "及び")
+
+
+def load_aliases(path=ALIAS_PATH):
+    # 別名表（CSV: 別名,科目名）を {正規化済み別名: 正規化済み科目名} で返す。ファイルがなければ空
+    if not path or not os.path.exists(path):
+        return {}
+    aliases = {}
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            alias = (row.get("別名") or "").strip()
+            canonical = (row.get("科目名") or "").strip()
+            if alias and canonical:
+                aliases[_normalize_raw(alias)] = _normalize_raw(canonical)
+    return aliases
+
+
+_default_aliases = None
+
+
+def default_aliases():
+    global _default_aliases
+    if _default_aliases is None:
+        _default_aliases = load_aliases()
+    return _default_aliases
+
+
+def normalize_subject(name, aliases=None):
+    key = _normalize_raw(name)
+    aliases = default_aliases() if aliases is None else aliases
+    return aliases.get(key, key)
+
+
+def normalize_subjects(values, aliases=None):
+    s = pd.Series(values, dtype=object).astype(str)
+    keys = (s.str.normalize("NFKC")
+            .str.strip()
+            .str.replace(" ", "", regex=False)
+            .str.replace("　", "", regex=False)
+            .str.replace("および", "及び", regex=False))
+    aliases = default_aliases() if aliases is None else aliases
+    if aliases:
+        keys = keys.map(aliases).fillna(keys)
+    return keys
+
+
+class SubjectIndex:
+    # 正規化キー → 行位置 のハッシュ表。同じキーが複数あれば先頭行を採用
+    def __init__(self, subjects, aliases=None):
+        self.labels = list(subjects)
+        self.keys = normalize_subjects(self.labels, aliases).to_numpy()
+        self.aliases = aliases
+        self._positions = {}
+        for pos, key in enumerate(self.keys):
+            self._positions.setdefault(key, pos)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, name):
+        return normalize_subject(name, self.aliases) in self._positions
+
+    def position(self, name):
+        return self._positions.get(normalize_subject(name, self.aliases))
+
+    def positions(self, names):
+        # 複数科目をまとめて引く。見つからない科目は -1
+        keys = normalize_subjects(names, self.aliases)
+        return np.fromiter((self._positions.get(k, -1) for k in keys), dtype=np.int64, count=len(keys))
+
+    def unique_positions(self):
+        return sorted(self._positions.values())
+
+
+def find_subject_column(columns):
+    # 「科目」を含む最初の列（空白・全角半角の揺れは無視）。見つからなければ None
+    for col in columns:
+        if "科目" in _normalize_raw(col):
+            return col
+    return None
+
+
+def index_by_subject(df, subject_col, aliases=None):
+    # 科目列を正規化キーのインデックスに置き換える（元の表記は「科目名」列に残す）
+    index = SubjectIndex(df[subject_col], aliases)
+    positions = index.unique_positions()
+    out = df.drop(columns=[subject_col]).iloc[positions].copy()
+    if LABEL_COL in out.columns:
+        out = out.drop(columns=[LABEL_COL])
+    labels = pd.Series(index.labels, dtype=object).iloc[positions].astype(str).str.strip()
+    out.insert(0, LABEL_COL, labels.to_numpy())
+    out.index = pd.Index(index.keys[positions], name=KEY_NAME)
+    return out
@@ -0,0 +1,125 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+from openpyxl import Workbook
+
+from header_parser import FISCAL_START, calendar_year_of
+
+# ベンチマーク用の合成データ
+# 実際の予算・実績ファイルと同じレイアウト（見出し6行・科目名列・「YYYY年 M月実績金額(発生)」列）で、
+# 科目数・月数・年度数・拠点数を増やしたブックを作る
+BASE_SUBJECTS = [
+    "売上高", "売上値引", "売上割戻", "純売上高", "期首商品棚卸高", "商品仕入高", "仕入値引", "棚卸廃棄損",
+    "他勘定振替高", "期末商品棚卸高", "売上原価", "売上総利益", "役員報酬", "給料手当", "法定福利費",
+    "福利厚生費", "賃借料", "保険料", "修繕費", "減価償却費", "図書印刷費", "事務管理費", "燃料費",
+    "水道光熱費", "その他消耗品費", "旅費交通費", "通信費", "販売手数料", "宣伝普及費", "販売促進費",
+    "交際費", "会議費", "運送費", "租税公課", "支払手数料", "雑  費", "販売費及び一般管理費", "営業利益",
+    "受取利息", "雑収入", "営業外収益", "雑損失", "営業外費用", "経常利益", "特別利益", "特別損失",
+    "税引前当期純利益", "当期純利益",
+]
+EMPTY_RATE = 0.1  # 金額が空欄の科目の割合
+
+Dataset = namedtuple("Dataset", ["budget_path", "actual_paths"])
+
+
+def subject_names(n_subjects):
+    # 実在の科目名を先頭に、足りない分は「補助科目NNNN」で埋める
+    names = BASE_SUBJECTS[:n_subjects]
+    names += [f"補助科目{i:04d}" for i in range(n_subjects - len(names))]
+    return names
+
+
+def fiscal_month_numbers(n_months, fiscal_start=FISCAL_START):
+    return [(fiscal_start - 1 + i) % 12 + 1 for i in range(n_months)]
+
+
+def _amounts(rng, n_subjects, n_columns):
+    # 科目ごとの規模に月ごとの揺らぎを掛けた金額（一部の科目は空欄）
+    scale = rng.lognormal(mean=14, sigma=1.5, size=(n_subjects, 1))
+    values = np.round(scale * rng.uniform(0.8, 1.2, size=(n_subjects, n_columns)))
+    empty = rng.random(n_subjects) < EMPTY_RATE
+    values[empty] = np.nan
+    return values
+
+
+def _cell(value):
+    return None if value != value else int(value)
+
+
+def _write_sheet(path, title, preamble, header, rows):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    for row in preamble:
+        ws.append(list(row))
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    tmp_path = f"{path}.tmp"
+    wb.save(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_budget(path, subjects, months, rng):
+    values = _amounts(rng, len(subjects), len(months))
+    preamble = [("科目別対比表",), ("合成データ",), (None,), ("税抜",), ("日常仕訳にまとめて集計する",), ("(単位：円)",)]
+    header = ["科目名", *[f"{m}月" for m in months]]
+    rows = ([name, *[_cell(v) for v in row]] for name, row in zip(subjects, values))
+    return _write_sheet(path, "Sheet1", preamble, header, rows)
+
+
+def write_actual(path, subjects, fiscal_year, month, current, prior, entity="合成データ株式会社"):
+    # current / prior: 科目ごとの当年・前年の発生額
+    year = calendar_year_of(fiscal_year, month)
+    preamble = [
+        ("メニュー名", "科目別対比表"),
+        ("集計期間", f"自 {year}年 {month:>2}月  1日"),
+        ("会社名", entity),
+        ("税処理", "税抜"),
+        ("整理仕訳の集計条件", "日常仕訳にまとめて集計する"),
+        ("単位設定", "(単位：円)"),
+    ]
+    header = [
+        "コード", "科目名",
+        f"{year}年{month:>2}月実績金額(発生)", f"{year - 1}年{month:>2}月実績金額(発生)", f"{month:>2}月前年比(発生)",
+        f"{year}年{month:>2}月実績金額(残高)", f"{year - 1}年{month:>2}月実績金額(残高)", f"{month:>2}月増減額(残高)",
+    ]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        yoy = np.round(current / prior * 100, 1)
+
+    def rows():
+        for i, name in enumerate(subjects):
+            cur, pre = _cell(current[i]), _cell(prior[i])
+            ratio = None if not np.isfinite(yoy[i]) else float(yoy[i])
+            diff = None if cur is None or pre is None else cur - pre
+            yield [str(4000 + i), name, cur, pre, ratio, cur, pre, diff]
+
+    return _write_sheet(path, "損益計算書", preamble, header, rows())
+
+
+def generate(out_dir, n_subjects=60, n_months=12, n_years=1, n_entities=1, fiscal_year=2025, seed=0):
+    # 戻り値: {拠点名: Dataset(予算ファイル, [実績ファイル, ...])}
+    # 実績ファイルは fiscal_year から遡って n_years 年度分、各年度 n_months か月分を作る
+    rng = np.random.default_rng(seed)
+    subjects = subject_names(n_subjects)
+    months = fiscal_month_numbers(n_months)
+    datasets = {}
+    for e in range(n_entities):
+        entity = f"拠点{e + 1:02d}"
+        entity_dir = os.path.join(out_dir, entity)
+        os.makedirs(entity_dir, exist_ok=True)
+        budget_path = write_budget(os.path.join(entity_dir, f"{fiscal_year}予算.xlsx"), subjects, months, rng)
+        # 最も古い年度の前年分から順に作り、前年列は1年前の当年列と同じ値にする
+        years = list(range(fiscal_year - n_years, fiscal_year + 1))
+        amounts = dict(zip(years, [_amounts(rng, n_subjects, n_months) for _ in years]))
+        actual_paths = []
+        for fy in years[1:]:
+            for i, m in enumerate(months):
+                name = f"PL_{calendar_year_of(fy, m)}年{m}月.xlsx"
+                actual_paths.append(write_actual(
+                    os.path.join(entity_dir, name), subjects, fy, m,
+                    amounts[fy][:, i], amounts[fy - 1][:, i], entity=entity,
+                ))
+        datasets[entity] = Dataset(budget_path, actual_paths)
+    return datasets
@@ -0,0 +1,247 @@
+import fnmatch
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from header_parser import FISCAL_START, FLOW, parse_header
+from workbook_cache import default_cache
+
+# アップロードファイルの保存先
+# 内容のハッシュが前回と同じファイルは書き直さず、変わったファイルだけ一時ファイル経由で置き換える
+# 保存済みファイルの一覧（ハッシュ・サイズ・検出した年月・解析日時）は目録に持ち（年月は画面の一覧表示に使う）、
+# ディレクトリが変わったとき（手作業での追加・削除）だけ走査し直す
+# 列指向ストア（pandas・pyarrow）は解析が要るときに読み込む（一覧の表示だけなら読み込まない）
+MANIFEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".yojitsu_cache", "uploads")
+MANIFEST_VERSION = 1
+
+
+class ReadWriteLock:
+    # 保存済みファイルの読み書きの排他（集計中は何人でも読め、アップロード・削除はそれらが終わるのを待って1人だけ）
+    # 書き込みを待っている間は新しい読み込みを始めない
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+# プロセス内で共有する保存済みファイルの排他
+FILES_LOCK = ReadWriteLock()
+
+
+def detect_period(columns, fiscal_start=FISCAL_START):
+    # 見出しのうち最も新しい発生額の列から (年度, 年, 月) を返す（見つからなければ None）
+    keys = [parse_header(c, fiscal_start) for c in columns]
+    flows = [k for k in keys if k is not None and k.measure == FLOW and k.year is not None]
+    if not flows:
+        return None
+    latest = max(flows, key=lambda k: (k.fiscal_year, (k.month - fiscal_start) % 12))
+    return latest.fiscal_year, latest.year, latest.month
+
+
+def entry_label(name, entry):
+    # 一覧表示用の名前。保存時に検出した年月（または読込エラー）を添える
+    if entry.get("error"):
+        return f"{name}（読込エラー）"
+    if entry.get("year") is None:
+        return name
+    return f"{name}（{entry['year']}年{entry['month']}月分）"
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class UploadStore:
+    def __init__(self, directory, name, pattern="*.xlsx", manifest_dir=MANIFEST_DIR):
+        self.directory = directory
+        self.pattern = pattern
+        self.manifest_path = os.path.join(manifest_dir, f"{name}.json")
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # --- 目録の読み書き ---
+    def _load(self):
+        if self._manifest is None:
+            try:
+                with open(self.manifest_path, encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+            if manifest.get("version") != MANIFEST_VERSION:
+                manifest = {"version": MANIFEST_VERSION, "dir_mtime_ns": None, "files": {}}
+            self._manifest = manifest
+        return self._manifest
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            data = json.dumps(self._manifest, ensure_ascii=False, indent=1).encode("utf-8")
+            _write_atomic(self.manifest_path, data)
+        except OSError:
+            # 目録を保存できなくても次回走査し直すだけ
+            pass
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _matches(self, name):
+        # Excel の一時ファイル（~$...）は対象外
+        return fnmatch.fnmatch(name, self.pattern) and not name.startswith("~$")
+
+    def _describe(self, path, digest, size, mtime_ns, columns=None, error=None):
+        period = detect_period(columns) if columns is not None else None
+        return {
+            "sha256": digest,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "fiscal_year": period[0] if period else None,
+            "year": period[1] if period else None,
+            "month": period[2] if period else None,
+            "parsed_at": time.strftime("%Y-%m-%dT%H:%M:%S") if columns is not None else None,
+            "error": error,
+        }
+
+    def _rescan(self, manifest):
+        # 目録にないファイル・サイズや更新日時が変わったファイルだけハッシュを取り直す
+        files = {}
+        with os.scandir(self.directory) as it:
+            found = {e.name: e.stat() for e in it if e.is_file() and self._matches(e.name)}
+        for name, st_ in sorted(found.items()):
+            path = self.path(name)
+            entry = manifest["files"].get(name)
+            unchanged = entry is not None and entry["size"] == st_.st_size and entry["mtime_ns"] == st_.st_mtime_ns
+            if unchanged:
+                default_cache.remember_digest(path, entry["sha256"])
+                if entry["parsed_at"] is not None:
+                    files[name] = entry
+                    continue
+            # 未解析・変更のあったファイルだけ列指向ストアを見る（できていればその見出しから年月を検出する）
+            import columnar_store
+
+            fresh = columnar_store.is_fresh(path)
+            if unchanged and not fresh:
+                files[name] = entry
+                continue
+            columns = columnar_store.columns_of(path) if fresh else None
+            files[name] = self._describe(path, default_cache.digest(path), st_.st_size, st_.st_mtime_ns, columns)
+        manifest["files"] = files
+
+    def _refresh(self):
+        manifest = self._load()
+        dir_mtime = self._dir_mtime()
+        if dir_mtime is None:
+            manifest["files"] = {}
+        elif manifest["dir_mtime_ns"] != dir_mtime:
+            self._rescan(manifest)
+            manifest["dir_mtime_ns"] = dir_mtime
+            self._save()
+        return manifest
+
+    # --- 公開API ---
+    def entries(self):
+        # {ファイル名: 目録の項目}（ファイル名順）
+        with self._lock:
+            return dict(sorted(self._refresh()["files"].items()))
+
+    def paths(self):
+        return [self.path(name) for name in self.entries()]
+
+    def save(self, name, data):
+        # 戻り値: (目録の項目, 書き込んだか)。内容が同じなら書き込み・解析も書き込みの排他も省く
+        import columnar_store
+
+        data = bytes(data)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(name)
+
+        def saved(manifest):
+            entry = manifest["files"].get(name)
+            return entry if entry is not None and entry["sha256"] == digest and os.path.exists(path) else None
+
+        with self._lock:
+            entry = saved(self._refresh())
+        if entry is not None:
+            return entry, False
+        # 書き込むときだけ FILES_LOCK を取り、集計中の読み込みが終わるのを待つ（FILES_LOCK → 目録の順に取る）
+        with FILES_LOCK.write(), self._lock:
+            manifest = self._refresh()
+            # 待っている間に同じ内容が保存されていれば書かない
+            entry = saved(manifest)
+            if entry is not None:
+                return entry, False
+            os.makedirs(self.directory, exist_ok=True)
+            _write_atomic(path, data)
+            default_cache.remember_digest(path, digest)
+            columns, error = None, None
+            try:
+                # 保存時に一度だけ解析して列指向ストアに変換（元のXLSXは残す）
+                columns = list(columnar_store.ingest(path).columns)
+            except Exception as e:
+                error = str(e)
+            st_ = os.stat(path)
+            entry = self._describe(path, digest, st_.st_size, st_.st_mtime_ns, columns, error)
+            manifest["files"][name] = entry
+            manifest["dir_mtime_ns"] = self._dir_mtime()
+            self._save()
+            return entry, True
+
+    def remove(self, name):
+        import columnar_store
+
+        path = self.path(name)
+        with self._lock:
+            manifest = self._refresh()
+            for target in (path, columnar_store.store_path(path)):
+                if os.path.exists(target):
+                    os.remove(target)
+            manifest["files"].pop(name, None)
+            manifest["dir_mtime_ns"] = self._dir_mtime()
+            self._save()
@@ -0,0 +1,192 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from fact_store import default_store
+from incremental import IncrementalAggregator
+from instrumentation import Recorder
+from upload_store import FILES_LOCK
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog がなければ一定間隔の確認だけで動く
+    Observer = None
+
+# 入力ファイルの監視と事前集計
+# 実績フォルダなどを一定間隔で確認し（watchdog があれば変更の通知でもすぐ起きる）、
+# 新しいファイル・変わったファイルを列指向ストアに変換して差分集計まで済ませておく
+# 集計結果は差分集計の状態として保存されるので、画面やバッチは変更のない状態から始められる
+POLL_SECONDS = float(os.environ.get("YOJITSU_WATCH_INTERVAL", "10"))
+
+# name: 表示・記録用の名前、budget_path: 予算ファイル、list_actuals: 実績ファイルのパス一覧を返す関数、
+# aggregators: 事前に実行しておく IncrementalAggregator、directories: 監視するフォルダ、
+# facts: (FactStore, 拠点名)。指定すればファクト表にも入れておく
+WatchTarget = namedtuple(
+    "WatchTarget", ["name", "budget_path", "list_actuals", "aggregators", "directories", "facts"], defaults=[None],
+)
+WatchStatus = namedtuple("WatchStatus", ["finished_at", "seconds", "affected_months", "error"])
+
+
+def _signature(paths):
+    # ファイルの大きさ・更新日時の組（書き込み途中でないかの確認にも使う）
+    sig = []
+    for path in paths:
+        try:
+            st_ = os.stat(path)
+            sig.append((path, st_.st_size, st_.st_mtime_ns))
+        except OSError:
+            sig.append((path, None, None))
+    return tuple(sig)
+
+
+class Watcher:
+    def __init__(self, targets, interval=POLL_SECONDS):
+        self.targets = list(targets)
+        self.interval = interval
+        self.status = {}
+        self._seen = {}
+        self._done = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._observer = None
+
+    def poll_once(self, wait_stable=True):
+        # 戻り値: 今回集計し直した対象の名前
+        ran = []
+        for target in self.targets:
+            if not os.path.exists(target.budget_path):
+                continue
+            actual_paths = list(target.list_actuals())
+            sig = _signature([target.budget_path, *actual_paths])
+            # 前回の確認から変わっていない（書き込みが終わっている）ものだけ集計する
+            stable = not wait_stable or self._seen.get(target.name) == sig
+            self._seen[target.name] = sig
+            if not stable or self._done.get(target.name) == sig:
+                continue
+            recorder = Recorder("監視")
+            start = time.perf_counter()
+            affected, error = [], None
+            # 年度は差分集計の結果から取る（集計しない対象はファクト表の同期で見出しから決める）
+            fiscal_year = None
+            try:
+                # 画面のアップロード・削除と同じファイル・状態を使うので、書き込み中は待つ
+                with FILES_LOCK.read():
+                    for aggregator in target.aggregators:
+                        with recorder.stage(f"事前集計({target.name})", rows=len(actual_paths)):
+                            result = aggregator.run(target.budget_path, actual_paths, recorder=recorder)
+                        affected.extend(m for m in result.affected_months if m not in affected)
+                        fiscal_year = result.resolver.fiscal_year
+                    if target.facts is not None:
+                        store, entity = target.facts
+                        with recorder.stage(f"ファクト同期({target.name})", rows=len(actual_paths)):
+                            store.sync(entity, target.budget_path, actual_paths,
+                                       fiscal_year=fiscal_year, recorder=recorder)
+            except Exception as e:
+                error = str(e)
+            finally:
+                recorder.flush()
+            # 失敗したときも同じ内容では繰り返さない（ファイルが変われば再度試す）
+            self._done[target.name] = sig
+            self.status[target.name] = WatchStatus(
+                time.strftime("%Y-%m-%dT%H:%M:%S"), time.perf_counter() - start, affected, error,
+            )
+            ran.append(target.name)
+        return ran
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception:
+                # 監視は止めない（次の確認で再度試す）
+                pass
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _watch_events(self):
+        if Observer is None:
+            return
+        wake = self._wake
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                wake.set()
+
+        observer = Observer()
+        for directory in {d for t in self.targets for d in t.directories if os.path.isdir(d)}:
+            observer.schedule(Handler(), directory, recursive=False)
+        observer.daemon = True
+        observer.start()
+        self._observer = observer
+
+    def start(self):
+        # 監視スレッドを起動して自分を返す（既に起動していれば何もしない）
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="yojitsu-watcher", daemon=True)
+            self._thread.start()
+            self._watch_events()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    # 単独のプロセスとして実行する（予実集計.py と同じ拠点のフォルダ・予算ファイル・実績ファイルを監視する）
+    import 予実集計 as batch
+
+    parser = argparse.ArgumentParser(description="実績ファイルを監視して事前に差分集計する")
+    parser.add_argument("directories", nargs="*", help="拠点のフォルダ（省略時は予実集計.py のフォルダ）")
+    parser.add_argument("--budget", default=batch.BUDGET_FILE, help="各フォルダの予算ファイル名")
+    parser.add_argument("--pattern", default=batch.ACTUAL_PATTERN, help="各フォルダの実績ファイル名のパターン")
+    parser.add_argument("--interval", type=float, default=POLL_SECONDS, help="確認の間隔（秒）")
+    parser.add_argument("--once", action="store_true", help="1回だけ集計して終了する")
+    args = parser.parse_args(argv)
+
+    targets = []
+    for directory in args.directories or [batch.SCRIPT_DIR]:
+        entity = batch.Entity(os.path.basename(os.path.normpath(os.path.abspath(directory))), directory,
+                              args.budget, args.pattern)
+        budget_path, _ = batch.entity_inputs(entity)
+        targets.append(WatchTarget(
+            entity.name, budget_path, lambda entity=entity: batch.entity_inputs(entity)[1],
+            [IncrementalAggregator(batch.state_name(directory), with_prior_year=False)], [os.path.abspath(directory)],
+            facts=(default_store, batch.state_name(directory)),
+        ))
+    watcher = Watcher(targets, interval=args.interval)
+    if args.once:
+        # 書き込みの確認を省いてすぐ集計する
+        watcher.poll_once(wait_stable=False)
+        for name, status in watcher.status.items():
+            print(name, status)
+        return
+    print(f"監視を開始します: {[t.name for t in targets]}（{args.interval:g}秒ごと）")
+    watcher.start()
+    shown = {}
+    try:
+        while True:
+            time.sleep(1)
+            for name, status in list(watcher.status.items()):
+                if shown.get(name) is not status:
+                    shown[name] = status
+                    print(f"{status.finished_at} {name} 事前集計: {status.seconds:.2f}秒 再計算した月: {status.affected_months}"
+                          + (f" エラー: {status.error}" if status.error else ""))
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
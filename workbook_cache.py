@@ -0,0 +1,153 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+# 読込済みワークブックのキャッシュと内容ハッシュ
+# ファイル内容のハッシュ＋読込オプションをキーに、メモリ（LRU）とディスクの2段で保持する
+# 読込済みの表は通常は列指向ストア（Parquet）に保存するので、このキャッシュは pyarrow がないときの ingest.read_many だけが使う
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".yojitsu_cache", "workbooks")
+MAX_MEMORY_ENTRIES = 64
+MAX_DISK_ENTRIES = 256
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class WorkbookCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_memory_entries=MAX_MEMORY_ENTRIES, max_disk_entries=MAX_DISK_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        # (絶対パス, mtime, サイズ) → 内容ハッシュ。変更のないファイルは再ハッシュしない
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        st_ = os.stat(path)
+        stat_key = (os.path.abspath(path), st_.st_mtime_ns, st_.st_size)
+        with self._lock:
+            cached = self._digests.get(stat_key)
+        if cached is not None:
+            return cached
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[stat_key] = digest
+        return digest
+
+    def remember_digest(self, path, digest):
+        # 書込側で内容ハッシュが分かっているときに登録しておく（読込時の再ハッシュを省く）
+        st_ = os.stat(path)
+        with self._lock:
+            self._digests[(os.path.abspath(path), st_.st_mtime_ns, st_.st_size)] = digest
+
+    def key(self, path, **read_kwargs):
+        # 読込エンジンの違いは結果に影響しないのでキーに含めない
+        opts = repr(sorted((k, v) for k, v in read_kwargs.items() if k != "engine"))
+        return hashlib.sha256(f"{self.digest(path)}|{opts}".encode("utf-8")).hexdigest()
+
+    def get(self, path, **read_kwargs):
+        key = self.key(path, **read_kwargs)
+        df = self._get_memory(key)
+        if df is None:
+            df = self._get_disk(key)
+            if df is None:
+                return None
+            self._put_memory(key, df)
+        # 呼び出し側で列を書き換えてもキャッシュが壊れないようコピーを返す
+        return df.copy()
+
+    def put(self, path, df, **read_kwargs):
+        key = self.key(path, **read_kwargs)
+        self._put_disk(key, df)
+        self._put_memory(key, df)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._digests.clear()
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".pkl"):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    # --- メモリ層 ---
+    def _get_memory(self, key):
+        with self._lock:
+            df = self._memory.get(key)
+            if df is not None:
+                self._memory.move_to_end(key)
+            return df
+
+    def _put_memory(self, key, df):
+        with self._lock:
+            self._memory[key] = df
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    # --- ディスク層 ---
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _get_disk(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                df = pickle.load(f)
+            # 最終利用時刻を更新（ディスク側のLRU判定に使う）
+            os.utime(path, None)
+            return df
+        except Exception:
+            # 壊れたキャッシュは捨てて読み直す
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _put_disk(self, key, df):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError:
+            # キャッシュ書込失敗は集計処理には影響させない
+            pass
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pkl"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        if len(entries) <= self.max_disk_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+default_cache = WorkbookCache()
@@ -1,156 +1,284 @@
-import pandas as pd
+import argparse
 import glob
+import hashlib
+import json
 import os
-import traceback
 import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from aggregation import (
+    ACTUAL, ANNUAL_COLUMNS, BATCH_COLUMNS, BUDGET, QUARTER_COLUMNS, consolidate, derive_monthly, flatten,
+    quarter_groups, rollup, thousand_yen,
+)
+from fact_store import comparison_table, default_store
+from forecast import SEASONAL, forecast, landing_table
+from incremental import STATE_DIR, IncrementalAggregator
+from instrumentation import Recorder
+from ingest import format_timings
+from period_index import YTD_COLUMNS, PeriodIndex
+from report_writer import write_report
+from subject_index import normalize_subjects
+
+# 予実集計（拠点ごとの集計と連結）
+# 拠点のフォルダごとに予算ファイル・実績ファイルを読み、月次・四半期・年間・累計の各表を1つのブックに出力する
+# 複数の拠点はプロセスプールで並列に処理し、全拠点を合算した連結のブックも出力する
+# 前年同月・前月との比較はファクト表（fact_store）から引くので、実績ファイルのパターン（--pattern）に前年度のファイルも
+# 含めれば、当年度のファイルに前年の列がなくても比較できる（当年度の実績は当年度の列だけから取り、前年度の値では埋めない）
+#   python 予実集計.py                           このスクリプトのフォルダを1拠点として集計
+#   python 予実集計.py 拠点A 拠点B ...           指定したフォルダをそれぞれ集計して連結
+#   python 予実集計.py --manifest 拠点一覧.json  一覧（[{"entity": 名前, "directory": フォルダ}, ...]）の拠点を集計
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BUDGET_FILE = "2025予算.xlsx"
+ACTUAL_PATTERN = "PL_2025年*.xlsx"
+# 月次・四半期・年間・累計の各表は1つのブックにシートを分けて出力する
+REPORT_FILE = "予実集計レポート.xlsx"
+CONSOLIDATED_FILE = "予実集計_連結レポート.xlsx"
+STATE_NAME = "予実集計"
+
+Entity = namedtuple("Entity", ["name", "directory", "budget_file", "pattern"], defaults=[BUDGET_FILE, ACTUAL_PATTERN])
+EntityResult = namedtuple(
+    "EntityResult", ["entity", "ok", "report_path", "written", "affected_months", "seconds", "error", "log", "monthly"],
+)
+
+
+def state_name(directory):
+    # 差分集計の状態の名前。このスクリプトのフォルダは従来どおり、それ以外はフォルダごとに分ける
+    directory = os.path.abspath(directory)
+    if directory == SCRIPT_DIR:
+        return STATE_NAME
+    digest = hashlib.sha1(directory.encode("utf-8")).hexdigest()[:8]
+    return f"{STATE_NAME}_{os.path.basename(directory)}_{digest}"
+
+
+def entity_inputs(entity):
+    # 戻り値: (予算ファイルのパス, 実績ファイルのパス一覧)
+    directory = os.path.abspath(entity.directory)
+    budget_path = os.path.join(directory, entity.budget_file)
+    return budget_path, sorted(glob.glob(os.path.join(directory, entity.pattern)))
+
+
+def with_prior_year(monthly, prior):
+    # ファクト表の前年同月の実績（円・科目キー索引）を月次結果の前年実績（千円）に入れ、前年比などを計算し直す
+    months = list(dict.fromkeys(monthly.columns.get_level_values(0)))
+    keys = normalize_subjects(monthly.index).to_numpy()
+
+    def part(measure):
+        return monthly.xs(measure, axis=1, level=1).reindex(columns=months).to_numpy(dtype=float)
+
+    prev = thousand_yen(prior.reindex(index=keys, columns=months)).to_numpy()
+    return derive_monthly(part(BUDGET), part(ACTUAL), prev, list(monthly.index), months)
+
+
+def report_sheets(monthly, quarter, annual, recorder):
+    # 月ごとの年度累計は累積和の差で各月時点の累計を一度に求める
+    with recorder.stage("累計集計", rows=len(monthly)):
+        ytd = PeriodIndex(monthly).ytd_table()
+    # 年間見込みは全科目を行列でまとめて推計する（前年実績があれば前年の季節性を使う）
+    with recorder.stage("年間見込み", rows=len(monthly)):
+        landing = landing_table(forecast(monthly), method=SEASONAL)
+    with recorder.stage("表整形", rows=len(monthly)):
+        return {
+            "月次予実表": flatten(monthly, BATCH_COLUMNS),
+            "四半期予実集計": flatten(quarter, QUARTER_COLUMNS),
+            "年間進捗集計": flatten(annual, ANNUAL_COLUMNS, label_format="{label}"),
+            "累計予実集計": flatten(ytd, YTD_COLUMNS),
+            "年間見込み": landing,
+        }
+
 
-print("=== 予実集計スクリプト 開始 ===")
-try:
-    print("1. 予算ファイル読込中...")
-    budget_file = "2025予算.xlsx"
-    budget_df = pd.read_excel(budget_file, skiprows=6)
-    print(f"   予算カラム名一覧: {budget_df.columns.tolist()}")
-    # 科目名列を自動検出
-    budget_subject_col = [col for col in budget_df.columns if '科目' in str(col)]
-    if budget_subject_col:
-        budget_subject_col = budget_subject_col[0]
-    else:
-        raise ValueError(f"予算ファイルに科目名列が見つかりません: {budget_df.columns.tolist()}")
-    print("2. 実績ファイル検索中...")
-    dir_path = os.path.dirname(os.path.abspath(__file__))
-    actual_files = sorted(glob.glob(os.path.join(dir_path, "PL_2025年*.xlsx")))
-    print(f"   検出ファイル: {actual_files}")
-
-    def extract_month(filename):
-        basename = os.path.basename(filename)
-        return basename.replace("PL_", "").replace(".xlsx", "")
-
-    actual_data = {}
-    for afile in actual_files:
-        month = extract_month(afile)
-        print(f"3. 実績ファイル読込中: {afile} → {month}")
-        df = pd.read_excel(afile, skiprows=6)
-        print(f"   カラム名一覧: {df.columns.tolist()}")
-        # 「科目名」列を自動検出（空白や表記揺れ対応）
-        col_candidates = [col for col in df.columns if '科目' in str(col)]
-        if col_candidates:
-            subject_col = col_candidates[0]
+def run_entity(entity, recorder=None, state_dir=STATE_DIR, store=default_store):
+    # 1拠点分の集計。例外は外に出さず EntityResult.ok / error で返す（表示する行は log に溜める）
+    # 性能測定（benchmark.py）は recorder・差分集計の状態の保存先・ファクト表を渡して同じ処理を測る
+    log = []
+    start = time.perf_counter()
+    # 段階ごとの時間・行数（YOJITSU_TRACE_MEMORY=1 ならピークメモリも）を timings.jsonl に記録する
+    # （recorder を渡されたときは記録の書き出しを呼び出し側に任せる）
+    own_recorder = recorder is None
+    if own_recorder:
+        recorder = Recorder("予実集計")
+    report_path = os.path.join(os.path.abspath(entity.directory), REPORT_FILE)
+    written, affected, monthly, error = False, [], None, None
+    try:
+        log.append("1. 予算ファイル読込中...")
+        log.append("2. 実績ファイル検索中...")
+        budget_path, actual_files = entity_inputs(entity)
+        log.append(f"   検出ファイル: {actual_files}")
+        if not actual_files:
+            raise FileNotFoundError(f"実績ファイルが見つかりません: {os.path.join(entity.directory, entity.pattern)}")
+
+        # 前回実行時から変更のあったファイルとその月だけを読み直して再計算する
+        # （予算・実績ファイルの読込はスレッドプールで並列に行う）
+        aggregator = IncrementalAggregator(state_name(entity.directory), with_prior_year=False, state_dir=state_dir)
+        with recorder.stage("差分集計"):
+            result = aggregator.run(budget_path, actual_files, recorder=recorder)
+        months = result.months
+        monthly = result.monthly
+        affected = list(result.affected_months)
+        log.append("   読込時間:")
+        log.extend(f"     {line}" for line in format_timings(result.timings))
+        log.append(f"3. 変更のあった実績ファイル: {[os.path.basename(p) for p in result.changed_paths]}")
+        log.append(f"4. 月リスト: {months}")
+        log.append(f"   再計算した月: {result.affected_months}")
+        actual_cols = result.resolver.current_map(months)
+        log.append(f"5. 実績カラム対応: { {m: col for m, (_, col) in actual_cols.items()} }")
+        # ファクト表に変わったファイルの分だけ入れる（前年同月・前月の値はここから引く）
+        entity_id = state_name(entity.directory)
+        with recorder.stage("ファクト同期", rows=len(actual_files)):
+            store.sync(entity_id, budget_path, actual_files, fiscal_year=result.resolver.fiscal_year,
+                               recorder=recorder)
+        values = None
+        if result.resolver.fiscal_year is not None:
+            with recorder.stage("前年実績", rows=len(monthly)):
+                values = store.comparison(entity_id, result.resolver.fiscal_year, months)
+                monthly = with_prior_year(monthly, values["prior_year"])
+
+        # 出力済みの版から変わっておらず出力が揃っていれば書き直さない
+        # （監視プロセスが先に差分集計を済ませていても、出力が古ければ書き直す）
+        # 前年実績・前年・前月比較・年間見込みはファクト表から引くので、ファクト表の同期番号も版に含める
+        revisions = {**result.revisions, "ファクト表": store.revision(entity_id)}
+        written = not aggregator.is_written(report_path, revisions) or not os.path.exists(report_path)
+        if written:
+            # 四半期集計・年間進捗は再計算した月を含む期間だけ集計し直す
+            quarter = aggregator.rollup("四半期", quarter_groups(months), recorder=recorder)
+            annual = aggregator.rollup("年間", {"年間": months}, recorder=recorder)
+            sheets = report_sheets(monthly, quarter, annual, recorder)
+            if values is not None:
+                with recorder.stage("前年・前月比較", rows=len(monthly)):
+                    sheets["前年・前月比較"] = comparison_table(values, list(monthly.index), months)
+            with recorder.stage("Excel出力", rows=sum(len(df) for df in sheets.values())):
+                write_report(report_path, sheets)
+            aggregator.mark_written(report_path, revisions)
+            log.append(f"6. 出力: {report_path}（{', '.join(sheets)}）")
+        else:
+            log.append("   変更なし: 出力ファイルの書き直しをスキップします")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        log.append("エラーが発生しました:")
+        log.extend(traceback.format_exc().rstrip().splitlines())
+    finally:
+        log.append("処理時間:")
+        log.extend(f"  {line}" for line in recorder.format_lines())
+        if own_recorder:
+            recorder.flush()
+    return EntityResult(
+        entity.name, error is None, report_path, written, affected, time.perf_counter() - start, error, log, monthly,
+    )
+
+
+def run_entities(entities, workers=None):
+    # 戻り値: 指定順の EntityResult のリスト。2拠点以上はプロセスプールで並列に処理する
+    if len(entities) <= 1 or workers == 1:
+        return [run_entity(e) for e in entities]
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_entity, e): i for i, e in enumerate(entities)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # ワーカープロセス自体が異常終了した場合
+                error = f"{type(e).__name__}: {e}"
+                results[i] = EntityResult(entities[i].name, False, None, False, [], 0.0, error, [], None)
+    return [results[i] for i in range(len(entities))]
+
+
+def write_consolidated(results, output=CONSOLIDATED_FILE):
+    # 成功した拠点の月次結果を合算した連結のブック。戻り値: 合算した拠点名のリスト
+    done = [r for r in results if r.ok and r.monthly is not None]
+    if not done:
+        return []
+    recorder = Recorder("予実集計(連結)")
+    try:
+        with recorder.stage("連結集計", rows=len(done)):
+            monthly = consolidate([r.monthly for r in done])
+        months = list(dict.fromkeys(monthly.columns.get_level_values(0)))
+        with recorder.stage("四半期集計", rows=len(monthly)):
+            quarter = rollup(monthly, quarter_groups(months))
+        with recorder.stage("年間集計", rows=len(monthly)):
+            annual = rollup(monthly, {"年間": months})
+        sheets = report_sheets(monthly, quarter, annual, recorder)
+        with recorder.stage("Excel出力", rows=sum(len(df) for df in sheets.values())):
+            write_report(output, sheets)
+    finally:
+        recorder.flush()
+    return [r.entity for r in done]
+
+
+def load_manifest(path):
+    # 拠点一覧（JSON の配列。要素はフォルダ名か {"entity", "directory", "budget_file", "pattern"}）
+    # 相対パスのフォルダは一覧ファイルの場所から見たパスとする
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    entities = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"directory": item}
+        directory = os.path.join(base, item["directory"])
+        entities.append(Entity(
+            item.get("entity") or os.path.basename(os.path.normpath(directory)), directory,
+            item.get("budget_file", BUDGET_FILE), item.get("pattern", ACTUAL_PATTERN),
+        ))
+    return entities
+
+
+def summary_lines(results):
+    lines = [f"{'拠点':<16}{'結果':<6}{'秒':>8}  再計算した月 / エラー"]
+    for r in results:
+        if r.ok:
+            status, detail = "成功", f"{r.affected_months}" + ("" if r.written else "（出力は前回のまま）")
         else:
-            raise ValueError(f"科目名列が見つかりません: {df.columns.tolist()}")
-        actual_data[month] = df.set_index(subject_col)
-
-    # 月カラム抽出（例：4月, 5月, ...）
-    months = [col for col in budget_df.columns if col not in [budget_subject_col, 'Unnamed: 13']]
-    print(f"4. 月リスト: {months}")
-
-    # 月ごとに該当する実績ファイル（actual_dataのキー）をマッピング
-    actual_file_map = {}
-    actual_col_map = {}
-    for k, df in actual_data.items():
-        for month in months:
-            # まず2025年のカラムを優先
-            found = False
-            for col in df.columns:
-                if '2025年' in col and month in col and '実績金額(発生)' in col:
-                    actual_file_map[month] = k
-                    actual_col_map[month] = col
-                    found = True
-                    break
-            # 2025年がなければ2024年を使う
-            if not found:
-                for col in df.columns:
-                    if '2024年' in col and month in col and '実績金額(発生)' in col:
-                        actual_file_map[month] = k
-                        actual_col_map[month] = col
-                        break
-    print(f"5. 実績カラム対応: {actual_col_map}")
-
-    def to_thousand_yen(x):
+            status, detail = "失敗", r.error
+        lines.append(f"{r.entity:<16}{status:<6}{r.seconds:>8.2f}  {detail}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="予算・実績ファイルを拠点ごとに集計し、連結のブックを出力する")
+    parser.add_argument("directories", nargs="*", help="拠点のフォルダ（省略時はこのスクリプトのフォルダ）")
+    parser.add_argument("--manifest", help="拠点一覧（JSON）")
+    parser.add_argument("--budget", default=BUDGET_FILE, help="各フォルダの予算ファイル名")
+    parser.add_argument("--pattern", default=ACTUAL_PATTERN, help="各フォルダの実績ファイル名のパターン")
+    parser.add_argument("--workers", type=int, default=None, help="並列に処理するプロセス数（省略時はCPU数）")
+    parser.add_argument("--consolidated", default=CONSOLIDATED_FILE, help="連結のブックの出力先")
+    args = parser.parse_args(argv)
+
+    entities = load_manifest(args.manifest) if args.manifest else []
+    entities += [
+        Entity(os.path.basename(os.path.normpath(os.path.abspath(d))), d, args.budget, args.pattern)
+        for d in args.directories
+    ]
+    if not entities:
+        entities = [Entity(os.path.basename(SCRIPT_DIR), SCRIPT_DIR, args.budget, args.pattern)]
+
+    print("=== 予実集計スクリプト 開始 ===")
+    results = run_entities(entities, workers=args.workers)
+    for r in results:
+        if len(results) > 1:
+            print(f"--- {r.entity} ---")
+        print("\n".join(r.log), file=sys.stdout if r.ok else sys.stderr, flush=True)
+    if len(results) > 1:
         try:
-            return round(float(x) / 1000)
-        except:
-            return ""
-
-    result = []
-    for subject in budget_df[budget_subject_col]:
-        row = {"科目名": subject}
-        for month in months:
-            budget = budget_df.loc[budget_df[budget_subject_col] == subject, month].values[0]
-            actual = ""
-            # 実績ファイル・カラムがあれば取得（なければ空欄）
-            if month in actual_file_map and month in actual_col_map:
-                df = actual_data[actual_file_map[month]]
-                col = actual_col_map[month]
-                if subject in df.index:
-                    try:
-                        actual = df.at[subject, col]
-                    except Exception:
-                        actual = ""
-            budget_ = to_thousand_yen(budget)
-            actual_ = to_thousand_yen(actual)
-            diff = "" if budget_ == "" or actual_ == "" else actual_ - budget_
-            rate = "" if budget_ in ["", 0] or actual_ == "" else round(actual_ / budget_ * 100, 1)
-            row[f"{month}_予算"] = budget_
-            row[f"{month}_実績"] = actual_
-            row[f"{month}_差額"] = diff
-            row[f"{month}_達成率"] = rate
-        result.append(row)
-
-    result_df = pd.DataFrame(result)
-    result_df.to_excel("月次予実表.xlsx", index=False)
+            merged = write_consolidated(results, args.consolidated)
+        except Exception:
+            print("連結の出力でエラーが発生しました:", file=sys.stderr)
+            traceback.print_exc()
+            return 1
+        if merged:
+            print(f"連結: {args.consolidated}（{len(merged)}拠点: {', '.join(merged)}）")
+        print("=== 拠点ごとの結果 ===")
+        print("\n".join(summary_lines(results)))
+    failed = [r for r in results if not r.ok]
+    if failed:
+        print(f"=== 予実集計スクリプト エラー終了（{len(failed)}拠点失敗） ===")
+        return 1
     print("=== 予実集計スクリプト 正常終了 ===")
+    return 0
+
 
-except Exception as e:
-    print("エラーが発生しました:", file=sys.stderr)
-    traceback.print_exc()
-
-# 四半期集計
-def quarter_sum(df, months, subject_col="科目名"):
-    q = [months[i:i+3] for i in range(0, len(months), 3)]
-    q_result = []
-    for subject in df[subject_col]:
-        row = {subject_col: subject}
-        for idx, q_months in enumerate(q, 1):
-            budget_sum = actual_sum = 0
-            for m in q_months:
-                b = df.loc[df[subject_col] == subject, f"{m}_予算"].values[0]
-                a = df.loc[df[subject_col] == subject, f"{m}_実績"].values[0]
-                budget_sum += b if b != "" else 0
-                actual_sum += a if a != "" else 0
-            diff = actual_sum - budget_sum if budget_sum != 0 else ""
-            rate = round(actual_sum / budget_sum * 100, 1) if budget_sum != 0 else ""
-            row[f"Q{idx}_予算合計"] = budget_sum if budget_sum != 0 else ""
-            row[f"Q{idx}_実績合計"] = actual_sum if actual_sum != 0 else ""
-            row[f"Q{idx}_差額"] = diff
-            row[f"Q{idx}_達成率"] = rate
-        q_result.append(row)
-    return pd.DataFrame(q_result)
-
-quarter_df = quarter_sum(result_df, months)
-quarter_df.to_excel("四半期予実集計.xlsx", index=False)
-
-# 年間進捗
-annual_result = []
-for subject in result_df["科目名"]:
-    budget_total = actual_total = 0
-    for month in months:
-        b = result_df.loc[result_df["科目名"] == subject, f"{month}_予算"].values[0]
-        a = result_df.loc[result_df["科目名"] == subject, f"{month}_実績"].values[0]
-        budget_total += b if b != "" else 0
-        actual_total += a if a != "" else 0
-    diff = actual_total - budget_total if budget_total != 0 else ""
-    rate = round(actual_total / budget_total * 100, 1) if budget_total != 0 else ""
-    # 年間見込み（単純月平均×12）
-    month_count = sum(1 for m in months if result_df.loc[result_df["科目名"] == subject, f"{m}_実績"].values[0] != "")
-    avg = actual_total / month_count if month_count else 0
-    forecast = round(avg * 12) if avg else ""
-    annual_result.append({
-        "科目名": subject,
-        "年間予算": budget_total if budget_total != 0 else "",
-        "実績累計": actual_total if actual_total != 0 else "",
-        "差額": diff,
-        "進捗率": rate,
-        "年間見込み（単純月平均×12）": forecast
-    })
-annual_df = pd.DataFrame(annual_result)
-annual_df.to_excel("年間進捗集計.xlsx", index=False)
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))